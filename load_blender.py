@@ -6,6 +6,8 @@ import json
 import torch.nn.functional as F
 import cv2
 
+from run_nerf_data import LazyImages
+
 
 trans_t = lambda t : torch.Tensor([
     [1,0,0,0],
@@ -34,7 +36,18 @@ def pose_spherical(theta, phi, radius):
     return c2w
 
 
-def load_blender_data(basedir, half_res=False, testskip=1):
+def _load_image(fname, size=None):
+    """One RGBA image as float32 in [0, 1], resized to size=(W, H) like the
+    half_res path of load_blender_data().
+    """
+    img = (imageio.imread(fname) / 255.).astype(np.float32)
+    return img if size is None else cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def load_blender_data(basedir, half_res=False, testskip=1, lazy=False):
+    """With lazy=True the images are returned as a LazyImages that decodes
+    (and resizes) each one only when it is indexed.
+    """
     splits = ['train', 'val', 'test']
     metas = {}
     for s in splits:
@@ -55,25 +68,36 @@ def load_blender_data(basedir, half_res=False, testskip=1):
             
         for frame in meta['frames'][::skip]:
             fname = os.path.join(basedir, frame['file_path'] + '.png')
-            imgs.append(imageio.imread(fname))
+            imgs.append(fname if lazy else imageio.imread(fname))
             poses.append(np.array(frame['transform_matrix']))
-        imgs = (np.array(imgs) / 255.).astype(np.float32) # keep all 4 channels (RGBA)
+        if not lazy:
+            imgs = (np.array(imgs) / 255.).astype(np.float32) # keep all 4 channels (RGBA)
         poses = np.array(poses).astype(np.float32)
-        counts.append(counts[-1] + imgs.shape[0])
+        counts.append(counts[-1] + len(imgs))
         all_imgs.append(imgs)
         all_poses.append(poses)
     
     i_split = [np.arange(counts[i], counts[i+1]) for i in range(3)]
     
-    imgs = np.concatenate(all_imgs, 0)
     poses = np.concatenate(all_poses, 0)
-    
-    H, W = imgs[0].shape[:2]
+    if lazy:
+        files = sum(all_imgs, [])
+        H, W = imageio.imread(files[0]).shape[:2]
+    else:
+        imgs = np.concatenate(all_imgs, 0)
+        H, W = imgs[0].shape[:2]
     camera_angle_x = float(meta['camera_angle_x'])
     focal = .5 * W / np.tan(.5 * camera_angle_x)
     
     render_poses = torch.stack([pose_spherical(angle, -30.0, 4.0) for angle in np.linspace(-180,180,40+1)[:-1]], 0)
     
+    if lazy:
+        size = (W//2, H//2) if half_res else None
+        load_fn = lambda f : _load_image(f, size)
+        if half_res:
+            H, W, focal = H//2, W//2, focal/2.
+        return LazyImages(files, load_fn, [len(files), H, W, 4]), poses, render_poses, [H, W, focal], i_split
+
     if half_res:
         H = H//2
         W = W//2
@@ -1,6 +1,8 @@
 import numpy as np
 import os, imageio
 
+from run_nerf_data import LazyImages
+
 
 ########## Slightly modified version of LLFF data loading code 
 ##########  see https://github.com/Fyusion/LLFF for original
@@ -59,7 +61,14 @@ def _minify(basedir, factors=[], resolutions=[]):
         
         
         
-def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True):
+def _imread(f):
+    if f.endswith('png'):
+        return imageio.imread(f,apply_gamma=False )# ignoregamma=True
+    else:
+        return imageio.imread(f)
+
+
+def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True, lazy=False):
     
     poses_arr = np.load(os.path.join(basedir, 'poses_bounds.npy'))
     poses = poses_arr[:, :-2].reshape([-1, 3, 5]).transpose([1,2,0])
@@ -104,14 +113,13 @@ def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True):
     
     if not load_imgs:
         return poses, bds
-    
-    def imread(f):
-        if f.endswith('png'):
-            return imageio.imread(f,apply_gamma=False )# ignoregamma=True
-        else:
-            return imageio.imread(f)
+
+    if lazy:
+        # Already [N, H, W, 3], decoded on access
+        load_fn = lambda f : (_imread(f)[...,:3]/255.).astype(np.float32)
+        return poses, bds, LazyImages(imgfiles, load_fn, [len(imgfiles), sh[0], sh[1], 3])
         
-    imgs = imgs = [imread(f)[...,:3]/255. for f in imgfiles]
+    imgs = imgs = [_imread(f)[...,:3]/255. for f in imgfiles]
     imgs = np.stack(imgs, -1)  
     
     print('Loaded image data', imgs.shape, poses[:,-1,0])
@@ -240,16 +248,19 @@ def spherify_poses(poses, bds):
     return poses_reset, new_poses, bds
     
 
-def load_llff_data(basedir, factor=8, recenter=True, bd_factor=.75, spherify=False, path_zflat=False):
-    
+def load_llff_data(basedir, factor=8, recenter=True, bd_factor=.75, spherify=False, path_zflat=False, lazy=False):
+    """With lazy=True the images are returned as a LazyImages that decodes
+    each one only when it is indexed.
+    """
 
-    poses, bds, imgs = _load_data(basedir, factor=factor) # factor=8 downsamples original imgs by 8x
+    poses, bds, imgs = _load_data(basedir, factor=factor, lazy=lazy) # factor=8 downsamples original imgs by 8x
     print('Loaded', basedir, bds.min(), bds.max())
     
     # Correct rotation matrix ordering and move variable dim to axis 0
     poses = np.concatenate([poses[:, 1:2, :], -poses[:, 0:1, :], poses[:, 2:, :]], 1)
     poses = np.moveaxis(poses, -1, 0).astype(np.float32)
-    imgs = np.moveaxis(imgs, -1, 0).astype(np.float32)
+    if not lazy:
+        imgs = np.moveaxis(imgs, -1, 0).astype(np.float32)
     images = imgs
     bds = np.moveaxis(bds, -1, 0).astype(np.float32)
     
@@ -310,7 +321,8 @@ def load_llff_data(basedir, factor=8, recenter=True, bd_factor=.75, spherify=Fal
     i_test = np.argmin(dists)
     print('HOLDOUT view is', i_test)
     
-    images = images.astype(np.float32)
+    if not lazy:
+        images = images.astype(np.float32)
     poses = poses.astype(np.float32)
 
     return images, poses, bds, render_poses, i_test
@@ -12,6 +12,10 @@ from tqdm import tqdm, trange
 import matplotlib.pyplot as plt
 
 from run_nerf_helpers import *
+from run_nerf_backends import *
+from run_nerf_octree import *
+from run_nerf_mesh import *
+from run_nerf_data import *
 
 from load_llff import load_llff_data
 from load_deepvoxels import load_dv_data
@@ -34,29 +38,171 @@ def batchify(fn, chunk):
     return ret
 
 
-def run_network(inputs, viewdirs, fn, embed_fn, embeddirs_fn, netchunk=1024*64):
+def run_network(inputs, viewdirs, fn, embed_fn, embeddirs_fn, netchunk=1024*64, factor_viewdirs=False,
+                z_vals=None, rays_d=None, shading_thresh=0., occupancy_grid=None):
     """Prepares inputs and applies network 'fn'.
     """
-    inputs_flat = torch.reshape(inputs, [-1, inputs.shape[-1]])
-    embedded = embed_fn(inputs_flat)
+    if occupancy_grid is not None:
+        return run_network_occupied(inputs, viewdirs, fn, embed_fn, embeddirs_fn, netchunk, occupancy_grid,
+                                    z_vals=z_vals, rays_d=rays_d, shading_thresh=shading_thresh)
+    if viewdirs is not None and hasattr(fn, 'forward_factored') and fn.use_viewdirs:
+        if shading_thresh > 0. and z_vals is not None:
+            return run_network_factored(inputs, viewdirs, fn, embed_fn, embeddirs_fn, netchunk,
+                                        z_vals=z_vals, rays_d=rays_d, shading_thresh=shading_thresh)
+        if factor_viewdirs:
+            return run_network_factored(inputs, viewdirs, fn, embed_fn, embeddirs_fn, netchunk)
 
-    if viewdirs is not None:
+    inputs_flat = torch.reshape(inputs, [-1, inputs.shape[-1]])
+    input_dirs_flat = None
+    if viewdirs is not None and getattr(fn, 'use_viewdirs', True):
         input_dirs = viewdirs[:,None].expand(inputs.shape)
         input_dirs_flat = torch.reshape(input_dirs, [-1, input_dirs.shape[-1]])
-        embedded_dirs = embeddirs_fn(input_dirs_flat)
-        embedded = torch.cat([embedded, embedded_dirs], -1)
 
-    outputs_flat = batchify(fn, netchunk)(embedded)
+    # Encoding happens inside the netchunk loop, the encodings of a whole
+    # render chunk can be far larger than the raw inputs. Without autograd
+    # nothing holds on to a chunk's encoding once fn has run, so every chunk
+    # is encoded into the first one's buffer.
+    chunk = inputs_flat.shape[0] if netchunk is None else netchunk
+    reuse = not torch.is_grad_enabled()
+    embedded, outputs = None, []
+    for i in range(0, inputs_flat.shape[0], chunk):
+        x = inputs_flat[i:i+chunk]
+        if embedded is None or not reuse:
+            embedded = embed_fn(x)
+            input_ch = embedded.shape[-1]
+            if input_dirs_flat is not None:
+                embedded = torch.cat([embedded, embeddirs_fn(input_dirs_flat[i:i+chunk])], -1)
+        else:
+            embedded = embedded[:x.shape[0]]
+            embed_fn(x, out=embedded[:, :input_ch])
+            if input_dirs_flat is not None:
+                embeddirs_fn(input_dirs_flat[i:i+chunk], out=embedded[:, input_ch:])
+        outputs.append(fn(embedded))
+    outputs_flat = torch.cat(outputs, 0)
     outputs = torch.reshape(outputs_flat, list(inputs.shape[:-1]) + [outputs_flat.shape[-1]])
     return outputs
 
 
+def run_network_factored(inputs, viewdirs, fn, embed_fn, embeddirs_fn, netchunk=1024*64,
+                         z_vals=None, rays_d=None, shading_thresh=0.):
+    """Like run_network(), but encodes each ray direction once and feeds it
+    through fn.forward_views() per ray instead of expanding viewdirs to every
+    sample. Chunks over whole rays so the per-ray term broadcasts in place.
+
+    If shading_thresh > 0, shading is deferred: the density trunk runs on all
+    samples, weights are computed from z_vals/rays_d, and the color head only
+    runs on samples whose weight exceeds shading_thresh. Skipped samples get a
+    raw rgb of 0; their contribution to the composite is below the threshold.
+    """
+    N_rays, N_samples = inputs.shape[:2]
+    embedded_dirs = embeddirs_fn(viewdirs)  # [N_rays, input_ch_views]
+
+    ray_chunk = max(1, netchunk // N_samples)
+    outputs = []
+    for i in range(0, N_rays, ray_chunk):
+        pts = inputs[i:i+ray_chunk]
+        embedded = torch.reshape(embed_fn(torch.reshape(pts, [-1, pts.shape[-1]])), list(pts.shape[:2]) + [-1])
+        views_term = fn.forward_views(embedded_dirs[i:i+ray_chunk])
+        if shading_thresh > 0.:
+            outputs.append(shade_deferred(fn, embedded, views_term,
+                                          z_vals[i:i+ray_chunk], rays_d[i:i+ray_chunk], shading_thresh))
+        else:
+            outputs.append(fn.forward_factored(embedded, views_term))
+    return torch.cat(outputs, 0)
+
+
+def shade_deferred(fn, embedded, views_term, z_vals, rays_d, shading_thresh):
+    """Two-phase query for one chunk of whole rays: density for every sample,
+    color only for samples with weight > shading_thresh.
+    """
+    h, alpha = fn.forward_density(embedded)  # [N_rays, N_samples, W], [N_rays, N_samples, 1]
+    weights = raw2weights(alpha[...,0], z_vals, rays_d)
+    mask = weights > shading_thresh
+
+    rgb = torch.zeros(list(alpha.shape[:-1]) + [3], dtype=alpha.dtype, device=alpha.device)
+    ray_idx, sample_idx = torch.nonzero(mask, as_tuple=True)
+    if ray_idx.shape[0] > 0:
+        rgb[ray_idx, sample_idx] = fn.forward_color(h[ray_idx, sample_idx], views_term[ray_idx])
+    return torch.cat([rgb, alpha], -1)
+
+
+def run_network_occupied(inputs, viewdirs, fn, embed_fn, embeddirs_fn, netchunk, occupancy_grid,
+                         z_vals=None, rays_d=None, shading_thresh=0.):
+    """Like run_network(), but fn is only evaluated at samples that fall in
+    occupied cells of occupancy_grid; samples in empty cells get raw outputs
+    of 0 (zero density). Chunks over whole rays, and within a chunk the
+    occupied samples are compacted into a flat list tagged with their ray.
+
+    Models with forward_factored() run the trunk on the compacted samples and
+    gather the per-ray view features (encoded once per ray, as in
+    run_network_factored()) by ray index. With shading_thresh > 0 shading is
+    deferred as in shade_deferred(): the color head only runs on compacted
+    samples whose weight exceeds shading_thresh.
+    """
+    N_rays, N_samples = inputs.shape[:2]
+    factored = viewdirs is not None and hasattr(fn, 'forward_factored') and fn.use_viewdirs
+    use_dirs = viewdirs is not None and getattr(fn, 'use_viewdirs', True)
+
+    ray_chunk = max(1, netchunk // N_samples)
+    outputs = []
+    for i in range(0, N_rays, ray_chunk):
+        pts = inputs[i:i+ray_chunk]
+        ray_idx, sample_idx = torch.nonzero(occupancy_grid.query(pts), as_tuple=True)
+        # May be empty, the network still gives its channel count
+        embedded = embed_fn(pts[ray_idx, sample_idx])
+
+        if factored:
+            views_term = fn.forward_views(embeddirs_fn(viewdirs[i:i+ray_chunk]))  # [ray_chunk, ...]
+            h, alpha_occ = fn.forward_density(embedded)
+            alpha = torch.zeros(list(pts.shape[:-1]) + [1], dtype=alpha_occ.dtype, device=alpha_occ.device)
+            alpha[ray_idx, sample_idx] = alpha_occ
+            if shading_thresh > 0.:
+                weights = raw2weights(alpha[...,0], z_vals[i:i+ray_chunk], rays_d[i:i+ray_chunk])
+                shade = weights[ray_idx, sample_idx] > shading_thresh
+                ray_idx, sample_idx, h = ray_idx[shade], sample_idx[shade], h[shade]
+            rgb = torch.zeros(list(pts.shape[:-1]) + [3], dtype=alpha.dtype, device=alpha.device)
+            rgb[ray_idx, sample_idx] = fn.forward_color(h, views_term[ray_idx])
+            outputs.append(torch.cat([rgb, alpha], -1))
+        else:
+            if use_dirs:
+                embedded = torch.cat([embedded, embeddirs_fn(viewdirs[i:i+ray_chunk])[ray_idx]], -1)
+            raw_occ = fn(embedded)
+            raw = torch.zeros(list(pts.shape[:-1]) + [raw_occ.shape[-1]], dtype=raw_occ.dtype, device=raw_occ.device)
+            raw[ray_idx, sample_idx] = raw_occ
+            outputs.append(raw)
+    return torch.cat(outputs, 0)
+
+
+def occupancy_density_fn(render_kwargs):
+    """pts [N, 3] -> raw density [N], for OccupancyGrid.update().
+
+    The grid follows the fine network's density but masks the coarse (or
+    proposal) pass too. The coarse pass only exists to place the fine samples,
+    and any coarse weight in a cell the fine network finds empty would spend
+    fine samples where they contribute nothing.
+    """
+    network_query_fn = render_kwargs['network_query_fn']
+    run_fn = render_kwargs['network_fn'] if render_kwargs['network_fine'] is None else render_kwargs['network_fine']
+    def density_fn(pts):
+        # Density does not depend on the view direction, any unit vector will do
+        viewdirs = F.normalize(torch.randn_like(pts), dim=-1) if render_kwargs['use_viewdirs'] else None
+        return network_query_fn(pts[:, None], viewdirs, run_fn)[:, 0, 3]
+    return density_fn
+
+
 def batchify_rays(rays_flat, chunk=1024*32, **kwargs):
     """Render rays in smaller minibatches to avoid OOM.
     """
     all_ret = {}
-    for i in range(0, rays_flat.shape[0], chunk):
+    # Adaptive fine samples a chunk leaves unspent go to the chunks after it
+    N = rays_flat.shape[0]
+    budget = kwargs.get('adaptive_samples', 0.) * N
+    for i in range(0, N, chunk):
+        if budget > 0:
+            kwargs['adaptive_samples'] = budget / (N - i)
         ret = render_rays(rays_flat[i:i+chunk], **kwargs)
+        if 'fine_samples' in ret:
+            budget -= ret['fine_samples'].sum().item()
         for k in ret:
             if k not in all_ret:
                 all_ret[k] = []
@@ -86,6 +232,9 @@ def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
       use_viewdirs: bool. If True, use viewing direction of a point in space in model.
       c2w_staticcam: array of shape [3, 4]. If not None, use this transformation matrix for 
        camera while using other c2w argument for viewing directions.
+      adaptive_budget: float. Fine samples per frame for adaptive sampling.
+      adaptive_rays: int. Number of rays in the frame adaptive_budget is for,
+        when rays only covers part of it. Defaults to the rays rendered.
     Returns:
       rgb_map: [batch_size, 3]. Predicted RGB values for rays.
       disp_map: [batch_size]. Disparity map. Inverse of depth.
@@ -122,6 +271,12 @@ def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
     if use_viewdirs:
         rays = torch.cat([rays, viewdirs], -1)
 
+    adaptive_budget = kwargs.pop('adaptive_budget', 0)
+    adaptive_rays = kwargs.pop('adaptive_rays', None)
+    if adaptive_budget > 0:
+        # The per-frame fine sample budget as a mean per ray of the frame
+        kwargs['adaptive_samples'] = adaptive_budget / (adaptive_rays or rays.shape[0])
+
     # Render and reshape
     all_ret = batchify_rays(rays, chunk, **kwargs)
     for k in all_ret:
@@ -151,7 +306,12 @@ def render_path(render_poses, hwf, K, chunk, render_kwargs, gt_imgs=None, savedi
     for i, c2w in enumerate(tqdm(render_poses)):
         print(i, time.time() - t)
         t = time.time()
-        rgb, disp, acc, _ = render(H, W, K, chunk=chunk, c2w=c2w[:3,:4], **render_kwargs)
+        rgb, disp, acc, extras = render(H, W, K, chunk=chunk, c2w=c2w[:3,:4], **render_kwargs)
+        if 'march_frac' in extras:
+            print('Samples skipped by early termination: {:.2f}%'.format(100. * (1. - extras['march_frac'].mean().item())))
+        if 'fine_samples' in extras:
+            print('Adaptive fine samples: {:.0f}, {:.2f}% of rays refined'.format(
+                extras['fine_samples'].sum().item(), 100. * (extras['fine_samples'] > 0).float().mean().item()))
         rgbs.append(rgb.cpu().numpy())
         disps.append(disp.cpu().numpy())
         if i==0:
@@ -175,36 +335,281 @@ def render_path(render_poses, hwf, K, chunk, render_kwargs, gt_imgs=None, savedi
     return rgbs, disps
 
 
+def render_progressive(H, W, K, c2w, chunk, render_kwargs, time_budget, preview_factor=8, sample_frac=.25, tile=32):
+    """Progressive rendering of one view for interactive preview.
+
+    Renders a pyramid of downsampled, undersampled previews starting at
+    1/preview_factor resolution, then re-renders full resolution tiles at
+    full sample counts, largest estimated error first, until time_budget
+    seconds have passed. The error of a tile is estimated from the change
+    between the last two preview levels plus its edge strength.
+
+    Yields:
+      rgb: [H, W, 3]. Current frame.
+      disp: [H, W]. Current disparity.
+      info: dict with the preview 'factor' of the frame (1 once tiles are
+        being refined), 'tiles_done', 'tiles_total' and 'elapsed' seconds.
+    """
+    t0 = time.time()
+    preview_kwargs = dict(render_kwargs, N_samples=max(2, int(render_kwargs['N_samples'] * sample_frac)))
+    if render_kwargs['N_importance'] > 0:
+        preview_kwargs['N_importance'] = max(1, int(render_kwargs['N_importance'] * sample_frac))
+    # An adaptive budget is per full resolution frame, not per preview or tile
+    if render_kwargs.get('adaptive_budget', 0) > 0:
+        preview_kwargs['adaptive_budget'] = render_kwargs['adaptive_budget'] * sample_frac
+        preview_kwargs['adaptive_rays'] = H * W
+        render_kwargs = dict(render_kwargs, adaptive_rays=H * W)
+    upsample = lambda x : F.interpolate(x.permute(2, 0, 1)[None], size=(H, W), mode='bilinear', align_corners=False)[0].permute(1, 2, 0)
+
+    ty, tx = (H + tile - 1) // tile, (W + tile - 1) // tile
+    info = {'factor' : preview_factor, 'tiles_done' : 0, 'tiles_total' : ty * tx, 'elapsed' : 0.}
+
+    # Preview pyramid. Each level has 4x the rays of the previous one, stop
+    # once the next level would overrun the budget
+    rgb = prev = disp = None
+    factor, ray_time = preview_factor, 0.
+    while factor > 1:
+        t = time.time()
+        K_f = np.array(K, dtype=np.float64)
+        K_f[:2] /= factor
+        rgb_f, disp_f, _, _ = render(H // factor, W // factor, K_f, chunk=chunk, c2w=c2w[:3,:4], **preview_kwargs)
+        prev, rgb, disp = rgb, upsample(rgb_f), upsample(disp_f[..., None])[..., 0]
+        ray_time = (time.time() - t) / ((H // factor) * (W // factor))
+        info.update(factor=factor, elapsed=time.time() - t0)
+        yield rgb, disp, dict(info)
+        factor //= 2
+        if info['elapsed'] + ray_time * (H // factor) * (W // factor) > time_budget:
+            break
+
+    if rgb is None:
+        rgb, disp = torch.zeros([H, W, 3]), torch.zeros([H, W])
+
+    # Tile error estimate
+    gray = rgb.mean(-1)
+    err = F.pad((gray[:, 1:] - gray[:, :-1]).abs(), (0, 1)) + F.pad((gray[1:] - gray[:-1]).abs(), (0, 0, 0, 1))
+    if prev is not None:
+        err = err + (rgb - prev).abs().mean(-1)
+    err = F.pad(err, (0, tx * tile - W, 0, ty * tile - H))
+    err = err.reshape(ty, tile, tx, tile).mean((1, 3)).reshape(-1)
+
+    # Tiles at full resolution. Full sample counts cost about 1/sample_frac more per ray
+    rays_o, rays_d = get_rays(H, W, K, c2w[:3,:4])
+    ray_time = ray_time / sample_frac
+    info['factor'] = 1
+    for i in torch.argsort(err, descending=True).tolist():
+        y, x = (i // tx) * tile, (i % tx) * tile
+        n_rays = min(tile, H - y) * min(tile, W - x)
+        if time.time() - t0 + ray_time * n_rays > time_budget:
+            break
+        t = time.time()
+        rays = torch.stack([rays_o[y:y+tile, x:x+tile], rays_d[y:y+tile, x:x+tile]], 0)
+        rgb_t, disp_t, _, _ = render(H, W, K, chunk=chunk, rays=rays, **render_kwargs)
+        rgb[y:y+tile, x:x+tile], disp[y:y+tile, x:x+tile] = rgb_t, disp_t
+        ray_time = (time.time() - t) / n_rays
+        info.update(tiles_done=info['tiles_done'] + 1, elapsed=time.time() - t0)
+        yield rgb, disp, dict(info)
+
+
+def bake_fastnerf_cache(render_kwargs, budget_mb, dir_res, bound):
+    """Evaluates the FactorizedNeRF (network_fine if present) on a position
+    grid over [-bound, bound]^3 and a direction grid of dir_res^2, at the
+    largest position resolution that fits in budget_mb of float16 storage.
+    """
+    fn = render_kwargs['network_fn'] if render_kwargs['network_fine'] is None else render_kwargs['network_fine']
+    assert isinstance(fn, FactorizedNeRF), "Baking needs a model trained with --fastnerf_components > 0"
+    network_query_fn = render_kwargs['network_query_fn']
+    K = fn.components
+
+    dir_bytes = dir_res**2 * K * 2
+    pos_res = int(((budget_mb * 2**20 - dir_bytes) / (2 * (3*K + 1)))**(1./3))
+    assert pos_res >= 2, "Memory budget too small for the direction grid"
+    cache = FastNeRFCache(pos_res, dir_res, K, bound).to(device)
+
+    # Query the two halves of the network through network_query_fn, so they see the same encodings
+    pos_fn = lambda x : torch.cat(fn.forward_density(x[..., :fn.input_ch]), -1)
+    dir_fn = lambda x : fn.forward_views(x[..., fn.input_ch:])
+    with torch.no_grad():
+        for i in trange(pos_res):
+            pts = cache.pos_points(i)
+            cache.pos_grid[i] = network_query_fn(pts, None, pos_fn).to(cache.pos_grid.dtype)
+        dirs = cache.dir_points().reshape(-1, 3)
+        cache.dir_grid.copy_(network_query_fn(torch.zeros_like(dirs)[:, None], dirs, dir_fn)[:, 0].reshape(cache.dir_grid.shape))
+    return cache
+
+
+def fastnerf_cache_error(cache, render_kwargs, n_pts=2**16, dist=0.02):
+    """Compares cache lookups with the live network at random points and
+    directions. Returns mean/max abs error of sigmoid rgb and of the opacity
+    of a dist long interval.
+    """
+    fn = render_kwargs['network_fn'] if render_kwargs['network_fine'] is None else render_kwargs['network_fine']
+    pts = (torch.rand([n_pts, 3]) * 2. - 1.) * cache.bound
+    viewdirs = F.normalize(torch.randn([n_pts, 3]), dim=-1)
+    with torch.no_grad():
+        live = render_kwargs['network_query_fn'](pts[:, None], viewdirs, fn)[:, 0]
+        cached = cache(pts[:, None], viewdirs)[:, 0]
+    rgb_err = (torch.sigmoid(live[..., :3]) - torch.sigmoid(cached[..., :3])).abs()
+    alpha_err = (raw2alpha(live[..., 3], dist) - raw2alpha(cached[..., 3], dist)).abs()
+    return {'rgb_mean' : rgb_err.mean().item(), 'rgb_max' : rgb_err.max().item(),
+            'alpha_mean' : alpha_err.mean().item(), 'alpha_max' : alpha_err.max().item()}
+
+
+def load_fastnerf_cache(path):
+    ckpt = torch.load(path)
+    state_dict = ckpt['cache_state_dict']
+    pos_res, dir_res = state_dict['pos_grid'].shape[0], state_dict['dir_grid'].shape[0]
+    cache = FastNeRFCache(pos_res, dir_res, state_dict['dir_grid'].shape[-1], ckpt['bound'])
+    cache.load_state_dict(state_dict)
+    return cache.to(device)
+
+
+def get_grid_schedule(args):
+    """Maps each upsampling iteration of an explicit backend to the
+    upsample() kwargs of its network_fn.
+    """
+    if args.backend not in ['grid', 'tensorf'] or not args.grid_upsample_iters:
+        return {}
+    upsample_iters = [int(it) for it in args.grid_upsample_iters.split(',')]
+    resolutions = grid_upsample_schedule(args.grid_res_init, args.grid_res_final, upsample_iters)
+    grid_schedule = {it : {'resolution' : resolutions[it]} for it in upsample_iters}
+    if args.backend == 'tensorf':
+        density_ranks = grid_upsample_schedule(args.tensorf_density_rank_init, args.tensorf_density_rank, upsample_iters)
+        app_ranks = grid_upsample_schedule(args.tensorf_app_rank_init, args.tensorf_app_rank, upsample_iters)
+        for it in upsample_iters:
+            grid_schedule[it].update(density_rank=density_ranks[it], app_rank=app_ranks[it])
+    return grid_schedule
+
+
+def distill_kilonerf(render_kwargs_train, optimizer, args):
+    """Fits the KiloNeRF network_fn to the latest checkpoint of the model
+    described by args.teacher_config. Cells that are empty under the teacher
+    are pruned first; the rest are fit on random points and directions.
+    """
+    teacher_args = config_parser().parse_args(['--config', args.teacher_config])
+    _, teacher_kwargs, teacher_start, _, _ = create_nerf(teacher_args)
+    assert teacher_start > 0, 'No trained checkpoint found for ' + args.teacher_config
+    teacher = teacher_kwargs['network_fn'] if teacher_kwargs['network_fine'] is None else teacher_kwargs['network_fine']
+    student = render_kwargs_train['network_fn']
+
+    kept = student.prune_cells(occupancy_density_fn(teacher_kwargs), args.kilo_prune_thresh)
+    print('KiloNeRF cells kept after pruning:', kept)
+
+    # Match opacity at the training step size rather than raw density
+    dist = (render_kwargs_train['far'] - render_kwargs_train['near']) / args.N_samples
+
+    for i in trange(args.distill_iters):
+        pts = student.random_points(args.distill_batch)
+        viewdirs = F.normalize(torch.randn_like(pts), dim=-1) if args.use_viewdirs else None
+        with torch.no_grad():
+            target = teacher_kwargs['network_query_fn'](pts[:, None], viewdirs, teacher)[:, 0]
+        raw = render_kwargs_train['network_query_fn'](pts[:, None], viewdirs, student)[:, 0]
+
+        loss = img2mse(torch.sigmoid(raw[...,:3]), torch.sigmoid(target[...,:3])) + img2mse(raw2alpha(raw[...,3], dist), raw2alpha(target[...,3], dist))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        if i%args.i_print==0:
+            tqdm.write(f"[DISTILL] Iter: {i} Loss: {loss.item()}")
+
+
 def create_nerf(args):
     """Instantiate NeRF's MLP model.
     """
-    embed_fn, input_ch = get_embedder(args.multires, args.i_embed)
+    hash_kwargs = {
+        'bound' : args.hash_bound,
+        'n_levels' : args.hash_levels,
+        'n_features' : args.hash_features,
+        'log2_table_size' : args.hash_log2_size,
+        'base_res' : args.hash_base_res,
+        'finest_res' : args.hash_finest_res,
+    }
+    # Explicit backends are queried at raw xyz
+    i_embed = -1 if args.backend != 'mlp' else args.i_embed
+    embed_fn, input_ch = get_embedder(args.multires, i_embed, analytic_grad=args.analytic_grad, hash_kwargs=hash_kwargs)
+    if isinstance(embed_fn, nn.Module):
+        embed_fn = embed_fn.to(device)
+
+    # Deferred shading splits the density trunk from the view-dependent color head
+    assert args.shading_thresh == 0. or args.use_viewdirs, "--shading_thresh needs use_viewdirs"
+    assert args.sh_degree < 0 or args.fastnerf_components == 0, "--sh_degree and --fastnerf_components are alternative view heads, pick one"
 
     input_ch_views = 0
     embeddirs_fn = None
     if args.use_viewdirs:
-        embeddirs_fn, input_ch_views = get_embedder(args.multires_views, args.i_embed)
+        # The hash grid only encodes positions, directions keep the frequency encoding
+        i_embed_views = 0 if args.i_embed == 1 else args.i_embed
+        if args.sh_degree >= 0:
+            # The SH head evaluates its basis on raw unit directions
+            i_embed_views = -1
+        embeddirs_fn, input_ch_views = get_embedder(args.multires_views, i_embed_views, analytic_grad=args.analytic_grad)
     output_ch = 5 if args.N_importance > 0 else 4
     skips = [4]
-    model = NeRF(D=args.netdepth, W=args.netwidth,
-                 input_ch=input_ch, output_ch=output_ch, skips=skips,
-                 input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs).to(device)
+
+    def make_nerf(D, W):
+        # NeRF or one of its alternative view-dependence heads
+        if args.fastnerf_components > 0:
+            assert args.use_viewdirs, "The factorized network needs use_viewdirs"
+            return FactorizedNeRF(D=D, W=W, input_ch=input_ch, input_ch_views=input_ch_views,
+                                  skips=skips, components=args.fastnerf_components,
+                                  D_dir=args.fastnerf_dir_depth, W_dir=args.fastnerf_dir_width)
+        if args.sh_degree >= 0:
+            assert args.use_viewdirs, "The SH head needs use_viewdirs"
+            return SHNeRF(D=D, W=W, input_ch=input_ch, skips=skips, sh_degree=args.sh_degree)
+        return NeRF(D=D, W=W, input_ch=input_ch, output_ch=output_ch, skips=skips,
+                    input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs)
+
+    if args.backend == 'grid':
+        model = VoxelGridNeRF(resolution=args.grid_res_init, bound=args.grid_bound, n_features=args.grid_features,
+                              D=args.netdepth, W=args.netwidth,
+                              input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs).to(device)
+    elif args.backend == 'tensorf':
+        model = TensoRFNeRF(resolution=args.grid_res_init, bound=args.grid_bound,
+                            density_rank=args.tensorf_density_rank_init, app_rank=args.tensorf_app_rank_init,
+                            n_features=args.grid_features, D=args.netdepth, W=args.netwidth,
+                            input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs).to(device)
+    elif args.backend == 'kilonerf':
+        model = KiloNeRF(grid_res=args.kilo_res, bound=args.grid_bound, multires=args.multires,
+                         D=args.netdepth, W=args.netwidth, input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs,
+                         block_size=args.kilo_block_size if args.kilo_block_size > 0 else None).to(device)
+    elif args.sampler == 'proposal':
+        assert args.N_importance > 0, "The proposal sampler needs N_importance > 0"
+        model = ProposalNeRF(D=args.netdepth_prop, W=args.netwidth_prop, input_ch=input_ch).to(device)
+    else:
+        model = make_nerf(args.netdepth, args.netwidth).to(device)
+    if isinstance(embed_fn, HashEmbedder):
+        # Register the hash tables on the coarse model so they are optimized
+        # and saved/loaded with network_fn_state_dict
+        model.add_module('embed_fn', embed_fn)
     grad_vars = list(model.parameters())
 
     model_fine = None
-    if args.N_importance > 0:
-        model_fine = NeRF(D=args.netdepth_fine, W=args.netwidth_fine,
-                          input_ch=input_ch, output_ch=output_ch, skips=skips,
-                          input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs).to(device)
+    if args.N_importance > 0 and args.backend == 'mlp':
+        model_fine = make_nerf(args.netdepth_fine, args.netwidth_fine).to(device)
         grad_vars += list(model_fine.parameters())
 
-    network_query_fn = lambda inputs, viewdirs, network_fn : run_network(inputs, viewdirs, network_fn,
+    network_query_fn = lambda inputs, viewdirs, network_fn, **kwargs : run_network(inputs, viewdirs, network_fn,
                                                                 embed_fn=embed_fn,
                                                                 embeddirs_fn=embeddirs_fn,
-                                                                netchunk=args.netchunk)
+                                                                netchunk=args.netchunk,
+                                                                factor_viewdirs=not args.no_factor_viewdirs,
+                                                                **kwargs)
+
+    occupancy_grid = None
+    if args.occ_grid:
+        occupancy_grid = OccupancyGrid(resolution=args.occ_res, bound=args.occ_bound, thresh=args.occ_thresh).to(device)
 
     # Create optimizer
-    optimizer = torch.optim.Adam(params=grad_vars, lr=args.lrate, betas=(0.9, 0.999))
+    if hasattr(model, 'grid_parameters'):
+        # Explicit grids learn with a larger step than the decoder MLP
+        grid_ids = set(id(p) for p in model.grid_parameters())
+        param_groups = [
+            {'params' : [p for p in grad_vars if id(p) in grid_ids], 'lr' : args.lrate * args.grid_lr_mult, 'lr_mult' : args.grid_lr_mult},
+            {'params' : [p for p in grad_vars if id(p) not in grid_ids]},
+        ]
+        optimizer = torch.optim.Adam(params=param_groups, lr=args.lrate, betas=(0.9, 0.999))
+    else:
+        optimizer = torch.optim.Adam(params=grad_vars, lr=args.lrate, betas=(0.9, 0.999))
 
     start = 0
     basedir = args.basedir
@@ -225,12 +630,20 @@ def create_nerf(args):
         ckpt = torch.load(ckpt_path)
 
         start = ckpt['global_step']
-        optimizer.load_state_dict(ckpt['optimizer_state_dict'])
 
         # Load model
-        model.load_state_dict(ckpt['network_fn_state_dict'])
+        if hasattr(model, 'grid_parameters'):
+            # Loading may resize the grids, so the optimizer state follows the model
+            old_params = list(model.parameters())
+            model.load_state_dict(ckpt['network_fn_state_dict'])
+            replace_optimizer_params(optimizer, old_params, list(model.parameters()))
+        else:
+            model.load_state_dict(ckpt['network_fn_state_dict'])
         if model_fine is not None:
             model_fine.load_state_dict(ckpt['network_fine_state_dict'])
+        optimizer.load_state_dict(ckpt['optimizer_state_dict'])
+        if occupancy_grid is not None and 'occupancy_grid_state_dict' in ckpt:
+            occupancy_grid.load_state_dict(ckpt['occupancy_grid_state_dict'])
 
     ##########################
 
@@ -244,6 +657,10 @@ def create_nerf(args):
         'use_viewdirs' : args.use_viewdirs,
         'white_bkgd' : args.white_bkgd,
         'raw_noise_std' : args.raw_noise_std,
+        'occupancy_grid' : occupancy_grid,
+        'fused_composite' : args.fused_composite,
+        'stratified_importance' : args.stratified_importance,
+        'reuse_coarse' : args.reuse_coarse,
     }
 
     # NDC only good for LLFF-style forward facing data
@@ -255,16 +672,39 @@ def create_nerf(args):
     render_kwargs_test = {k : render_kwargs_train[k] for k in render_kwargs_train}
     render_kwargs_test['perturb'] = False
     render_kwargs_test['raw_noise_std'] = 0.
+    render_kwargs_test['shading_thresh'] = args.shading_thresh
+    render_kwargs_test['term_eps'] = args.term_eps
+    render_kwargs_test['march_segment'] = args.march_segment
+    render_kwargs_test['adaptive_budget'] = args.adaptive_budget
 
     return render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer
 
 
-def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=False):
+def raw2weights(sigma, z_vals, rays_d):
+    """Compositing weights from raw density alone, as computed in raw2outputs
+    (without noise).
+    Args:
+        sigma: [num_rays, num_samples along ray]. Raw density from model.
+        z_vals: [num_rays, num_samples along ray]. Integration time.
+        rays_d: [num_rays, 3]. Direction of each ray.
+    Returns:
+        weights: [num_rays, num_samples]. Weights assigned to each sample.
+    """
+    dists = z_vals[...,1:] - z_vals[...,:-1]
+    dists = torch.cat([dists, torch.Tensor([1e10]).expand(dists[...,:1].shape)], -1)  # [N_rays, N_samples]
+    dists = dists * torch.norm(rays_d[...,None,:], dim=-1)
+
+    return composite_weights(sigma, dists)[2]
+
+
+def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=False, fused=False):
     """Transforms model's predictions to semantically meaningful values.
     Args:
         raw: [num_rays, num_samples along ray, 4]. Prediction from model.
         z_vals: [num_rays, num_samples along ray]. Integration time.
         rays_d: [num_rays, 3]. Direction of each ray.
+        fused: bool. If True, composite with composite_rays(), which recomputes
+          the intermediates in backward instead of storing them.
     Returns:
         rgb_map: [num_rays, 3]. Estimated RGB color of a ray.
         disp_map: [num_rays]. Disparity map. Inverse of depth map.
@@ -272,14 +712,11 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=F
         weights: [num_rays, num_samples]. Weights assigned to each sampled color.
         depth_map: [num_rays]. Estimated distance to object.
     """
-    raw2alpha = lambda raw, dists, act_fn=F.relu: 1.-torch.exp(-act_fn(raw)*dists)
-
     dists = z_vals[...,1:] - z_vals[...,:-1]
     dists = torch.cat([dists, torch.Tensor([1e10]).expand(dists[...,:1].shape)], -1)  # [N_rays, N_samples]
 
     dists = dists * torch.norm(rays_d[...,None,:], dim=-1)
 
-    rgb = torch.sigmoid(raw[...,:3])  # [N_rays, N_samples, 3]
     noise = 0.
     if raw_noise_std > 0.:
         noise = torch.randn(raw[...,3].shape) * raw_noise_std
@@ -290,9 +727,15 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=F
             noise = np.random.rand(*list(raw[...,3].shape)) * raw_noise_std
             noise = torch.Tensor(noise)
 
-    alpha = raw2alpha(raw[...,3] + noise, dists)  # [N_rays, N_samples]
-    # weights = alpha * tf.math.cumprod(1.-alpha + 1e-10, -1, exclusive=True)
-    weights = alpha * torch.cumprod(torch.cat([torch.ones((alpha.shape[0], 1)), 1.-alpha + 1e-10], -1), -1)[:, :-1]
+    if fused:
+        rgb_map, depth_map, acc_map, weights = composite_rays(raw[...,3] + noise, raw[...,:3], dists, z_vals)
+        disp_map = 1./torch.max(1e-10 * torch.ones_like(depth_map), depth_map / acc_map)
+        if white_bkgd:
+            rgb_map = rgb_map + (1.-acc_map[...,None])
+        return rgb_map, disp_map, acc_map, weights, depth_map
+
+    rgb = torch.sigmoid(raw[...,:3])  # [N_rays, N_samples, 3]
+    _, _, weights = composite_weights(raw[...,3] + noise, dists)  # [N_rays, N_samples]
     rgb_map = torch.sum(weights[...,None] * rgb, -2)  # [N_rays, 3]
 
     depth_map = torch.sum(weights * z_vals, -1)
@@ -305,6 +748,133 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=F
     return rgb_map, disp_map, acc_map, weights, depth_map
 
 
+def march_rays(z_vals, rays_o, rays_d, viewdirs, fn, network_query_fn,
+               occupancy_grid=None, white_bkgd=False, segment=16, term_eps=1e-4):
+    """Inference-only replacement for querying the network at every sample and
+    calling raw2outputs(). Samples are processed in depth-ordered segments;
+    after each segment, rays whose transmittance dropped below term_eps are
+    terminated and only the surviving rays are passed on to the next one.
+    Args:
+      z_vals: [num_rays, num_samples along ray]. Sorted integration times.
+      segment: int. Number of samples per ray per network call.
+      term_eps: float. Transmittance below which a ray is terminated.
+    Returns:
+      rgb_map, disp_map, acc_map, weights, depth_map: As in raw2outputs().
+      raw: [num_rays, num_samples, C]. Raw predictions, 0 after termination.
+      n_evaluated: [num_rays]. Number of samples actually queried per ray.
+    """
+    N_rays, N_samples = z_vals.shape
+    dists = z_vals[...,1:] - z_vals[...,:-1]
+    dists = torch.cat([dists, torch.Tensor([1e10]).expand(dists[...,:1].shape)], -1)  # [N_rays, N_samples]
+    dists = dists * torch.norm(rays_d[...,None,:], dim=-1)
+
+    transmittance = torch.ones([N_rays])
+    weights = torch.zeros([N_rays, N_samples])
+    rgb_map = torch.zeros([N_rays, 3])
+    n_evaluated = torch.zeros([N_rays])
+    raw = None
+    live = torch.arange(N_rays, device=z_vals.device)
+    for s0 in range(0, N_samples, segment):
+        s1 = min(N_samples, s0 + segment)
+        pts = rays_o[live,None,:] + rays_d[live,None,:] * z_vals[live,s0:s1,None]
+        dirs = viewdirs[live] if viewdirs is not None else None
+        raw_seg = network_query_fn(pts, dirs, fn, occupancy_grid=occupancy_grid)
+        if raw is None:
+            raw = torch.zeros([N_rays, N_samples, raw_seg.shape[-1]])
+        raw[live, s0:s1] = raw_seg
+
+        # Same compositing as raw2outputs, seeded with the transmittance
+        # carried over from the previous segments
+        _, trans, w = composite_weights(raw_seg[...,3], dists[live, s0:s1], transmittance[live])
+        weights[live, s0:s1] = w
+        rgb_map[live] += torch.sum(w[...,None] * torch.sigmoid(raw_seg[...,:3]), -2)
+        transmittance[live] = trans[:, -1]
+        n_evaluated[live] += s1 - s0
+
+        live = live[transmittance[live] > term_eps]
+        if live.shape[0] == 0:
+            break
+
+    depth_map = torch.sum(weights * z_vals, -1)
+    disp_map = 1./torch.max(1e-10 * torch.ones_like(depth_map), depth_map / torch.sum(weights, -1))
+    acc_map = torch.sum(weights, -1)
+
+    if white_bkgd:
+        rgb_map = rgb_map + (1.-acc_map[...,None])
+
+    return rgb_map, disp_map, acc_map, weights, depth_map, raw, n_evaluated
+
+
+def adaptive_counts(weights, budget, max_per_ray):
+    """Splits budget fine samples over rays in proportion to the accumulated
+    opacity times the perplexity (exp entropy) of their coarse weights, i.e.
+    the number of bins the ray's content is spread over. Empty rays get none.
+    What rays capped at max_per_ray would get beyond it goes to the others,
+    and the samples lost to rounding down to the largest remainders.
+    """
+    acc = weights.sum(-1)
+    p = weights / (acc[...,None] + 1e-10)
+    perplexity = torch.exp(-(p * torch.log(p + 1e-10)).sum(-1))
+    score = acc * perplexity
+
+    capped = torch.zeros_like(score, dtype=torch.bool)
+    while True:
+        free = torch.where(capped, torch.zeros_like(score), score)
+        share = (budget - max_per_ray * capped.sum().item()) * free / (free.sum() + 1e-10)
+        over = share >= max_per_ray
+        if not over.any():
+            break
+        capped |= over
+    share = torch.where(capped, torch.full_like(share, max_per_ray), share)
+
+    counts = torch.floor(share)
+    frac = share - counts
+    n_left = min(int(budget - counts.sum().item()), int((frac > 0).sum().item()))
+    if n_left > 0:
+        counts[torch.topk(frac, n_left).indices] += 1
+    return counts.long()
+
+
+def adaptive_fine_pass(counts, z_vals, weights, raw, rays_o, rays_d, viewdirs, run_fn, network_query_fn,
+                       det, reuse_coarse, raw_noise_std, white_bkgd, fused, occupancy_grid=None):
+    """Fine pass with counts[i] importance samples on ray i. Only rays with
+    counts > 0 are composited again, and only their valid samples are
+    queried, packed into one batch of length-one rays.
+    Returns rgb/disp/acc maps and z_samples [N_active, max(counts)] of the
+    active rays, with their index.
+    """
+    idx = torch.nonzero(counts > 0, as_tuple=False)[:, 0]
+    counts, z_vals, weights, raw = counts[idx], z_vals[idx], weights[idx], raw[idx]
+    rays_o, rays_d = rays_o[idx], rays_d[idx]
+    viewdirs = viewdirs[idx] if viewdirs is not None else None
+
+    z_vals_mid = .5 * (z_vals[...,1:] + z_vals[...,:-1])
+    z_samples = sample_pdf_ragged(z_vals_mid, weights[...,1:-1], counts, det=det).detach()
+
+    # Packed query of the valid new samples
+    valid = torch.arange(z_samples.shape[-1]) < counts[:,None]
+    ray_idx, sample_idx = torch.nonzero(valid, as_tuple=True)
+    pts = rays_o[ray_idx] + rays_d[ray_idx] * z_samples[ray_idx, sample_idx][:,None]
+    dirs = viewdirs[ray_idx] if viewdirs is not None else None
+    raw_packed = network_query_fn(pts[:,None], dirs, run_fn, occupancy_grid=occupancy_grid)[:,0]
+
+    # Padding samples go far behind the ray with zero density
+    raw_new = torch.zeros(list(z_samples.shape) + [raw_packed.shape[-1]], dtype=raw_packed.dtype)
+    raw_new[ray_idx, sample_idx] = raw_packed
+    z_pad = torch.where(valid, z_samples, 1e10 * torch.ones_like(z_samples))
+
+    if reuse_coarse:
+        raw_coarse = raw[...,:raw_packed.shape[-1]]
+    else:
+        pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None]
+        raw_coarse = network_query_fn(pts, viewdirs, run_fn, occupancy_grid=occupancy_grid)
+    z_all, perm = merge_sorted(z_vals, z_pad)
+    raw_all = torch.gather(torch.cat([raw_coarse, raw_new], -2), -2, perm[...,None].expand(list(perm.shape) + [raw_new.shape[-1]]))
+
+    rgb_map, disp_map, acc_map, _, _ = raw2outputs(raw_all, z_all, rays_d, raw_noise_std, white_bkgd, fused=fused)
+    return rgb_map, disp_map, acc_map, torch.where(valid, z_samples, torch.zeros_like(z_samples)), idx
+
+
 def render_rays(ray_batch,
                 network_fn,
                 network_query_fn,
@@ -317,7 +887,17 @@ def render_rays(ray_batch,
                 white_bkgd=False,
                 raw_noise_std=0.,
                 verbose=False,
-                pytest=False):
+                pytest=False,
+                shading_thresh=0.,
+                occupancy_grid=None,
+                term_eps=0.,
+                march_segment=16,
+                fused_composite=False,
+                stratified_importance=False,
+                reuse_coarse=False,
+                fastnerf_cache=None,
+                octree=None,
+                adaptive_samples=0.):
     """Volumetric rendering.
     Args:
       ray_batch: array of shape [batch_size, ...]. All information necessary
@@ -337,6 +917,31 @@ def render_rays(ray_batch,
       white_bkgd: bool. If True, assume a white background.
       raw_noise_std: ...
       verbose: bool. If True, print more debugging info.
+      shading_thresh: float. If > 0, only run the color head on samples whose
+        compositing weight exceeds this value (inference only).
+      occupancy_grid: OccupancyGrid. If given, samples in empty cells are not
+        passed to the network and get zero density.
+      term_eps: float. If > 0, march samples in segments of march_segment and
+        stop querying rays once their transmittance falls below term_eps
+        (inference only).
+      fused_composite: bool. If True, use the memory-lean compositing op in
+        raw2outputs.
+      stratified_importance: bool. If True and perturb > 0, draw one uniform
+        per stratum when sampling the importance pdf.
+      reuse_coarse: bool. If True, the fine pass only queries the N_importance
+        new samples and reuses the coarse pass outputs at the N_samples coarse
+        points, compositing both sets together. Ignored with a density-only
+        proposal network, which has no colors to reuse.
+      fastnerf_cache: FastNeRFCache. If given, every query is a cache lookup
+        and neither network is evaluated.
+      octree: PlenOctree. If given, rays are integrated through the octree
+        instead of being sampled and queried, and only rgb/disp/acc maps are
+        returned.
+      adaptive_samples: float. If > 0, the fine pass draws on average this
+        many samples per ray, allocated from the coarse weights by
+        adaptive_counts() and capped at 2 * N_importance. Rays that get none
+        keep their coarse outputs (inference only, not with a proposal
+        network or term_eps).
     Returns:
       rgb_map: [num_rays, 3]. Estimated RGB color of a ray. Comes from fine model.
       disp_map: [num_rays]. Disparity map. 1 / depth.
@@ -345,15 +950,34 @@ def render_rays(ray_batch,
       rgb0: See rgb_map. Output for coarse model.
       disp0: See disp_map. Output for coarse model.
       acc0: See acc_map. Output for coarse model.
+      prop_loss: [num_rays]. Histogram bound loss of the proposal network,
+        replaces rgb0/disp0/acc0 when network_fn is a ProposalNeRF.
       z_std: [num_rays]. Standard deviation of distances along ray for each
         sample.
+      march_frac: [num_rays]. Fraction of samples actually queried, only
+        present when term_eps > 0.
+      fine_samples: [num_rays]. Fine samples drawn for each ray, only present
+        when adaptive_samples > 0.
     """
+    if fastnerf_cache is not None:
+        def network_query_fn(inputs, viewdirs, network_fn, occupancy_grid=None, **kwargs):
+            raw = fastnerf_cache(inputs, viewdirs)
+            # Lookups are cheap, empty cells are just zeroed afterwards
+            return raw if occupancy_grid is None else raw * occupancy_grid.query(inputs)[...,None]
+
     N_rays = ray_batch.shape[0]
     rays_o, rays_d = ray_batch[:,0:3], ray_batch[:,3:6] # [N_rays, 3] each
     viewdirs = ray_batch[:,-3:] if ray_batch.shape[-1] > 8 else None
     bounds = torch.reshape(ray_batch[...,6:8], [-1,1,2])
     near, far = bounds[...,0], bounds[...,1] # [-1,1]
 
+    if octree is not None:
+        if viewdirs is None:
+            viewdirs = rays_d / torch.norm(rays_d, dim=-1, keepdim=True)
+        rgb_map, disp_map, acc_map = octree.render(rays_o, rays_d, viewdirs, near[...,0], far[...,0], white_bkgd,
+                                                   term_eps if term_eps > 0. else 1e-4)
+        return {'rgb_map' : rgb_map, 'disp_map' : disp_map, 'acc_map' : acc_map}
+
     t_vals = torch.linspace(0., 1., steps=N_samples)
     if not lindisp:
         z_vals = near * (1.-t_vals) + far * (t_vals)
@@ -381,35 +1005,98 @@ def render_rays(ray_batch,
     pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None] # [N_rays, N_samples, 3]
 
 
-#     raw = run_network(pts)
-    raw = network_query_fn(pts, viewdirs, network_fn)
-    rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest)
+    # Deferred shading needs the sample depths to compute weights inside the query.
+    # Not for the coarse pass if its colors are reused in the fine composite.
+    deferred_kwargs = lambda z_vals : {'z_vals' : z_vals, 'rays_d' : rays_d, 'shading_thresh' : shading_thresh} if shading_thresh > 0. else {}
+    deferred_kwargs_coarse = deferred_kwargs if not (reuse_coarse and N_importance > 0) else (lambda z_vals : {})
 
-    if N_importance > 0:
+    # A density-only proposal network stands in for the coarse NeRF: it only
+    # provides the weights that drive sample_pdf
+    proposal = getattr(network_fn, 'density_only', False) and fastnerf_cache is None
 
+#     raw = run_network(pts)
+    if proposal:
+        raw = network_query_fn(pts, viewdirs, network_fn, occupancy_grid=occupancy_grid)
+        weights = raw2weights(raw[...,0], z_vals, rays_d)
+        n_evaluated, n_total = N_samples * torch.ones([N_rays]), N_samples
+    elif term_eps > 0.:
+        rgb_map, disp_map, acc_map, weights, depth_map, raw, n_evaluated = march_rays(
+            z_vals, rays_o, rays_d, viewdirs, network_fn, network_query_fn, occupancy_grid, white_bkgd, march_segment, term_eps)
+        n_total = N_samples
+    else:
+        raw = network_query_fn(pts, viewdirs, network_fn, occupancy_grid=occupancy_grid, **deferred_kwargs_coarse(z_vals))
+        rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest, fused=fused_composite)
+
+    adaptive = N_importance > 0 and adaptive_samples > 0. and not proposal and term_eps == 0.
+    if adaptive:
         rgb_map_0, disp_map_0, acc_map_0 = rgb_map, disp_map, acc_map
+        counts = adaptive_counts(weights, adaptive_samples * N_rays, 2 * N_importance)
+        z_std = torch.zeros([N_rays])
+        if counts.sum() > 0:
+            run_fn = network_fn if network_fine is None else network_fine
+            rgb_a, disp_a, acc_a, z_a, idx = adaptive_fine_pass(counts, z_vals, weights, raw, rays_o, rays_d, viewdirs, run_fn, network_query_fn,
+                                                                perturb==0., reuse_coarse, raw_noise_std, white_bkgd, fused_composite,
+                                                                occupancy_grid)
+            rgb_map, disp_map, acc_map = rgb_map.index_put((idx,), rgb_a), disp_map.index_put((idx,), disp_a), acc_map.index_put((idx,), acc_a)
+            n = counts[idx].float()
+            mean = z_a.sum(-1) / n
+            valid = torch.arange(z_a.shape[-1]) < n[:,None]
+            z_std = z_std.index_put((idx,), torch.sqrt((((z_a - mean[:,None]) * valid) ** 2).sum(-1) / n))
+
+    elif N_importance > 0:
+
+        if not proposal:
+            rgb_map_0, disp_map_0, acc_map_0 = rgb_map, disp_map, acc_map
+        z_vals_0, weights_0 = z_vals, weights
 
         z_vals_mid = .5 * (z_vals[...,1:] + z_vals[...,:-1])
-        z_samples = sample_pdf(z_vals_mid, weights[...,1:-1], N_importance, det=(perturb==0.), pytest=pytest)
+        z_samples = sample_pdf(z_vals_mid, weights[...,1:-1], N_importance, det=(perturb==0.), pytest=pytest, stratified=stratified_importance)
         z_samples = z_samples.detach()
 
-        z_vals, _ = torch.sort(torch.cat([z_vals, z_samples], -1), -1)
+        if not (perturb == 0. or (stratified_importance and not pytest)):
+            # Only the importance samples need sorting, z_vals already is
+            z_samples, _ = torch.sort(z_samples, -1)
+        z_vals, perm = merge_sorted(z_vals, z_samples)
         pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None] # [N_rays, N_samples + N_importance, 3]
 
         run_fn = network_fn if network_fine is None else network_fine
 #         raw = run_network(pts, fn=run_fn)
-        raw = network_query_fn(pts, viewdirs, run_fn)
+        if reuse_coarse and term_eps == 0. and not proposal:
+            # Only query the new samples and slot in the coarse pass outputs
+            pts = rays_o[...,None,:] + rays_d[...,None,:] * z_samples[...,:,None] # [N_rays, N_importance, 3]
+            raw_new = network_query_fn(pts, viewdirs, run_fn, occupancy_grid=occupancy_grid)
+            raw = torch.cat([raw[...,:raw_new.shape[-1]], raw_new], -2)
+            raw = torch.gather(raw, -2, perm[...,None].expand(list(perm.shape) + [raw.shape[-1]]))
+
+            rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest, fused=fused_composite)
+        elif term_eps > 0.:
+            rgb_map, disp_map, acc_map, weights, depth_map, raw, n_evaluated_fine = march_rays(
+                z_vals, rays_o, rays_d, viewdirs, run_fn, network_query_fn, occupancy_grid, white_bkgd, march_segment, term_eps)
+            n_evaluated = n_evaluated + n_evaluated_fine
+            n_total += N_samples + N_importance
+        else:
+            raw = network_query_fn(pts, viewdirs, run_fn, occupancy_grid=occupancy_grid, **deferred_kwargs(z_vals))
 
-        rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest)
+            rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest, fused=fused_composite)
 
     ret = {'rgb_map' : rgb_map, 'disp_map' : disp_map, 'acc_map' : acc_map}
     if retraw:
         ret['raw'] = raw
     if N_importance > 0:
-        ret['rgb0'] = rgb_map_0
-        ret['disp0'] = disp_map_0
-        ret['acc0'] = acc_map_0
-        ret['z_std'] = torch.std(z_samples, dim=-1, unbiased=False)  # [N_rays]
+        if proposal:
+            # Every sample is treated as the interval up to the next one (or far)
+            far_edge = far.expand([N_rays, 1])
+            ret['prop_loss'] = proposal_loss(torch.cat([z_vals_0, far_edge], -1), weights_0,
+                                             torch.cat([z_vals, far_edge], -1), weights)
+        else:
+            ret['rgb0'] = rgb_map_0
+            ret['disp0'] = disp_map_0
+            ret['acc0'] = acc_map_0
+        ret['z_std'] = z_std if adaptive else torch.std(z_samples, dim=-1, unbiased=False)  # [N_rays]
+    if adaptive:
+        ret['fine_samples'] = counts.float()
+    if term_eps > 0.:
+        ret['march_frac'] = n_evaluated / n_total
 
     for k in ret:
         if (torch.isnan(ret[k]).any() or torch.isinf(ret[k]).any()) and DEBUG:
@@ -440,6 +1127,58 @@ def config_parser():
                         help='layers in fine network')
     parser.add_argument("--netwidth_fine", type=int, default=256, 
                         help='channels per layer in fine network')
+    parser.add_argument("--backend", type=str, default='mlp', 
+                        help='scene representation: mlp for the NeRF MLP, grid for a dense voxel grid, tensorf for a VM-factorized grid, kilonerf for a grid of tiny MLPs')
+    parser.add_argument("--grid_res_init", type=int, default=64, 
+                        help='initial voxel grid resolution per axis')
+    parser.add_argument("--grid_res_final", type=int, default=160, 
+                        help='voxel grid resolution per axis after the last upsampling')
+    parser.add_argument("--grid_upsample_iters", type=str, default='2000,4000,6000', 
+                        help='comma separated iterations at which the grid backends are pruned and upsampled')
+    parser.add_argument("--grid_prune_thresh", type=float, default=0.01, 
+                        help='voxels with density below this (and in an empty neighbourhood) are pruned')
+    parser.add_argument("--grid_bound", type=float, default=1.5, 
+                        help='explicit grids and baked caches cover [-bound, bound]^3')
+    parser.add_argument("--grid_features", type=int, default=12, 
+                        help='color feature channels per voxel')
+    parser.add_argument("--grid_lr_mult", type=float, default=20., 
+                        help='learning rate multiplier for explicit grid parameters')
+    parser.add_argument("--tensorf_density_rank_init", type=int, default=8, 
+                        help='initial density components per axis of the tensorf backend')
+    parser.add_argument("--tensorf_density_rank", type=int, default=16, 
+                        help='density components per axis after the last upsampling')
+    parser.add_argument("--tensorf_app_rank_init", type=int, default=24, 
+                        help='initial appearance components per axis of the tensorf backend')
+    parser.add_argument("--tensorf_app_rank", type=int, default=48, 
+                        help='appearance components per axis after the last upsampling')
+    parser.add_argument("--kilo_res", type=int, default=16, 
+                        help='kilonerf backend uses kilo_res^3 tiny MLPs of netdepth x netwidth')
+    parser.add_argument("--kilo_block_size", type=int, default=0, 
+                        help='rows per batched matmul block in kilonerf, 0 to pick from the sample count')
+    parser.add_argument("--kilo_prune_thresh", type=float, default=5., 
+                        help='kilonerf cells whose teacher density stays below this are never evaluated')
+    parser.add_argument("--teacher_config", type=str, default=None, 
+                        help='config of a trained model to distill the kilonerf backend from before training')
+    parser.add_argument("--distill_iters", type=int, default=20000, 
+                        help='number of distillation steps')
+    parser.add_argument("--distill_batch", type=int, default=8192, 
+                        help='points per distillation step')
+    parser.add_argument("--fastnerf_components", type=int, default=0, 
+                        help='if > 0, factorize the MLPs FastNeRF-style into this many position-dependent rgb components')
+    parser.add_argument("--fastnerf_dir_depth", type=int, default=3, 
+                        help='layers in the direction network of the factorized MLPs')
+    parser.add_argument("--fastnerf_dir_width", type=int, default=128, 
+                        help='channels per layer in the direction network of the factorized MLPs')
+    parser.add_argument("--sh_degree", type=int, default=-1, 
+                        help='if >= 0, replace the view-direction MLP with per-sample SH coefficients of this degree (max 4)')
+    parser.add_argument("--sampler", type=str, default='nerf', 
+                        help='coarse model: nerf for a full coarse NeRF, proposal for a small density-only network')
+    parser.add_argument("--netdepth_prop", type=int, default=2, 
+                        help='layers in proposal network')
+    parser.add_argument("--netwidth_prop", type=int, default=64, 
+                        help='channels per layer in proposal network')
+    parser.add_argument("--prop_loss_mult", type=float, default=1., 
+                        help='weight of the proposal histogram bound loss')
     parser.add_argument("--N_rand", type=int, default=32*32*4, 
                         help='batch size (number of random rays per gradient step)')
     parser.add_argument("--lrate", type=float, default=5e-4, 
@@ -452,6 +1191,16 @@ def config_parser():
                         help='number of pts sent through network in parallel, decrease if running out of memory')
     parser.add_argument("--no_batching", action='store_true', 
                         help='only take random rays from 1 image at a time')
+    parser.add_argument("--prefetch_workers", type=int, default=2, 
+                        help='threads preparing --no_batching batches ahead of training, 0 to prepare them inline')
+    parser.add_argument("--prefetch_depth", type=int, default=4, 
+                        help='number of --no_batching batches prepared ahead')
+    parser.add_argument("--pixel_cache", action='store_true', 
+                        help='stream training pixels from an on-disk cache in the experiment dir, for datasets larger than memory')
+    parser.add_argument("--pixel_cache_block", type=int, default=65536, 
+                        help='pixels per sequential read from the pixel cache')
+    parser.add_argument("--pixel_cache_prefetch", type=int, default=8, 
+                        help='number of pixel cache blocks read ahead by the loader thread')
     parser.add_argument("--no_reload", action='store_true', 
                         help='do not reload weights from saved ckpt')
     parser.add_argument("--ft_path", type=str, default=None, 
@@ -464,23 +1213,115 @@ def config_parser():
                         help='number of additional fine samples per ray')
     parser.add_argument("--perturb", type=float, default=1.,
                         help='set to 0. for no jitter, 1. for jitter')
+    parser.add_argument("--stratified_importance", action='store_true', 
+                        help='use stratified instead of i.i.d. uniforms when sampling the importance pdf')
+    parser.add_argument("--reuse_coarse", action='store_true', 
+                        help='fine pass only queries the importance samples and reuses coarse outputs at the coarse points')
     parser.add_argument("--use_viewdirs", action='store_true', 
                         help='use full 5D input instead of 3D')
+    parser.add_argument("--fused_composite", action='store_true', 
+                        help='composite with a custom autograd op that recomputes intermediates in backward, lowers memory use')
+    parser.add_argument("--no_factor_viewdirs", action='store_true', 
+                        help='expand viewdirs to every sample instead of evaluating the direction branch once per ray')
     parser.add_argument("--i_embed", type=int, default=0, 
-                        help='set 0 for default positional encoding, -1 for none')
+                        help='set 0 for default positional encoding, 1 for multiresolution hash encoding, -1 for none')
+    parser.add_argument("--hash_bound", type=float, default=1.5, 
+                        help='hash encoding covers [-bound, bound]^3')
+    parser.add_argument("--hash_levels", type=int, default=16, 
+                        help='number of hash encoding levels')
+    parser.add_argument("--hash_features", type=int, default=2, 
+                        help='features per hash encoding level')
+    parser.add_argument("--hash_log2_size", type=int, default=19, 
+                        help='log2 of hash table entries per level')
+    parser.add_argument("--hash_base_res", type=int, default=16, 
+                        help='grid resolution of the coarsest hash encoding level')
+    parser.add_argument("--hash_finest_res", type=int, default=2048, 
+                        help='grid resolution of the finest hash encoding level')
     parser.add_argument("--multires", type=int, default=10, 
                         help='log2 of max freq for positional encoding (3D location)')
     parser.add_argument("--multires_views", type=int, default=4, 
                         help='log2 of max freq for positional encoding (2D direction)')
+    parser.add_argument("--analytic_grad", action='store_true', 
+                        help='backpropagate through the positional encoding with its hand-written backward, for inputs that require grad')
     parser.add_argument("--raw_noise_std", type=float, default=0., 
                         help='std dev of noise added to regularize sigma_a output, 1e0 recommended')
 
+    parser.add_argument("--shading_thresh", type=float, default=0., 
+                        help='at test time, only evaluate the color branch for samples with weight above this, 0 to disable')
+
+    parser.add_argument("--term_eps", type=float, default=0., 
+                        help='at test time, stop marching a ray once its transmittance falls below this, 0 to disable')
+    parser.add_argument("--march_segment", type=int, default=16, 
+                        help='number of samples per ray evaluated between early termination checks')
+    parser.add_argument("--adaptive_budget", type=float, default=0., 
+                        help='at test time, total fine samples per rendered frame, allocated per ray from the coarse weights, 0 to disable')
+    parser.add_argument("--occ_grid", action='store_true', 
+                        help='skip samples in empty space using an occupancy grid updated during training')
+    parser.add_argument("--occ_res", type=int, default=64, 
+                        help='occupancy grid resolution per axis')
+    parser.add_argument("--occ_bound", type=float, default=1.5, 
+                        help='occupancy grid covers [-bound, bound]^3, samples outside are treated as empty')
+    parser.add_argument("--occ_thresh", type=float, default=0.01, 
+                        help='density above which an occupancy grid cell is marked occupied')
+    parser.add_argument("--occ_update_every", type=int, default=16, 
+                        help='frequency of occupancy grid updates (in iterations)')
+    parser.add_argument("--occ_warmup", type=int, default=256, 
+                        help='number of iterations before the first occupancy grid update')
+    parser.add_argument("--occ_update_frac", type=float, default=0.25, 
+                        help='fraction of occupancy grid cells queried per update, drawn uniformly plus as many among the occupied cells (the first update queries all)')
+
     parser.add_argument("--render_only", action='store_true', 
                         help='do not optimize, reload weights and render out render_poses path')
     parser.add_argument("--render_test", action='store_true', 
                         help='render the test set instead of render_poses path')
     parser.add_argument("--render_factor", type=int, default=0, 
                         help='downsampling factor to speed up rendering, set 4 or 8 for fast preview')
+    parser.add_argument("--bake_fastnerf", action='store_true', 
+                        help='bake the factorized MLP into a FastNeRF cache, report its error and exit')
+    parser.add_argument("--fastnerf_budget_mb", type=float, default=1024., 
+                        help='memory budget of the baked cache in MB (float16)')
+    parser.add_argument("--fastnerf_dir_res", type=int, default=128, 
+                        help='resolution of the baked direction grid')
+    parser.add_argument("--render_fastnerf", action='store_true', 
+                        help='render test views and videos from the baked cache instead of the MLPs')
+    parser.add_argument("--bake_octree", action='store_true', 
+                        help='bake the model into a PlenOctree of density and SH coefficients and exit')
+    parser.add_argument("--octree_depth", type=int, default=9, 
+                        help='octree depth, leaves are 2^depth per axis over [-grid_bound, grid_bound]^3')
+    parser.add_argument("--octree_sigma_thresh", type=float, default=1., 
+                        help='voxels with raw density below this are not baked')
+    parser.add_argument("--octree_weight_thresh", type=float, default=0.01, 
+                        help='leaves whose max weight over training rays is below this are pruned')
+    parser.add_argument("--octree_prune_rays", type=int, default=4096, 
+                        help='random pixels per training view used for weight pruning')
+    parser.add_argument("--octree_sh_degree", type=int, default=2, 
+                        help='SH degree used when converting a model without an SH head')
+    parser.add_argument("--octree_n_dirs", type=int, default=64, 
+                        help='directions per voxel used when converting a model without an SH head')
+    parser.add_argument("--render_octree", action='store_true', 
+                        help='render test views and videos from the baked octree instead of the MLPs')
+    parser.add_argument("--render_progressive", action='store_true', 
+                        help='progressively render the first test view within progressive_budget and save every frame')
+    parser.add_argument("--progressive_budget", type=float, default=1., 
+                        help='time budget of a progressive render in seconds')
+    parser.add_argument("--progressive_factor", type=int, default=8, 
+                        help='downsampling factor of the first progressive preview')
+    parser.add_argument("--progressive_sample_frac", type=float, default=.25, 
+                        help='fraction of N_samples/N_importance used by the progressive previews')
+    parser.add_argument("--progressive_tile", type=int, default=32, 
+                        help='tile size of the full resolution progressive refinement')
+    parser.add_argument("--export_mesh", action='store_true', 
+                        help='extract a colored marching-cubes mesh of the density field and exit')
+    parser.add_argument("--mesh_res", type=int, default=512, 
+                        help='lattice samples per axis over [-grid_bound, grid_bound]^3')
+    parser.add_argument("--mesh_block", type=int, default=64, 
+                        help='lattice cells per axis evaluated at once, bounds the memory use')
+    parser.add_argument("--mesh_thresh", type=float, default=50., 
+                        help='raw density of the extracted level set')
+    parser.add_argument("--mesh_coarse_stride", type=int, default=4, 
+                        help='stride of the pre-pass that skips empty blocks, 0 to evaluate every block')
+    parser.add_argument("--mesh_format", type=str, default='ply', 
+                        help='options: ply / obj')
 
     # training options
     parser.add_argument("--precrop_iters", type=int, default=0,
@@ -536,12 +1377,16 @@ def train():
     parser = config_parser()
     args = parser.parse_args()
 
+    # With the pixel cache, images are only decoded when indexed, so training
+    # from a valid cache never decodes the training views
+    lazy = args.pixel_cache and not args.no_batching
+
     # Load data
     K = None
     if args.dataset_type == 'llff':
         images, poses, bds, render_poses, i_test = load_llff_data(args.datadir, args.factor,
                                                                   recenter=True, bd_factor=.75,
-                                                                  spherify=args.spherify)
+                                                                  spherify=args.spherify, lazy=lazy)
         hwf = poses[0,:3,-1]
         poses = poses[:,:3,:4]
         print('Loaded llff', images.shape, render_poses.shape, hwf, args.datadir)
@@ -567,14 +1412,17 @@ def train():
         print('NEAR FAR', near, far)
 
     elif args.dataset_type == 'blender':
-        images, poses, render_poses, hwf, i_split = load_blender_data(args.datadir, args.half_res, args.testskip)
+        images, poses, render_poses, hwf, i_split = load_blender_data(args.datadir, args.half_res, args.testskip, lazy=lazy)
         print('Loaded blender', images.shape, render_poses.shape, hwf, args.datadir)
         i_train, i_val, i_test = i_split
 
         near = 2.
         far = 6.
 
-        if args.white_bkgd:
+        if lazy:
+            white_bkgd = args.white_bkgd
+            images = images.map(lambda img : img[...,:3]*img[...,-1:] + (1.-img[...,-1:]) if white_bkgd else img[...,:3], 3)
+        elif args.white_bkgd:
             images = images[...,:3]*images[...,-1:] + (1.-images[...,-1:])
         else:
             images = images[...,:3]
@@ -650,6 +1498,93 @@ def train():
     # Move testing data to GPU
     render_poses = torch.Tensor(render_poses).to(device)
 
+    if args.backend == 'kilonerf' and args.teacher_config is not None and start == 0:
+        distill_kilonerf(render_kwargs_train, optimizer, args)
+        start = global_step = args.distill_iters
+        path = os.path.join(basedir, expname, '{:06d}.tar'.format(start))
+        torch.save({
+            'global_step': global_step,
+            'network_fn_state_dict': render_kwargs_train['network_fn'].state_dict(),
+            'network_fine_state_dict': None,
+            'optimizer_state_dict': optimizer.state_dict(),
+        }, path)
+        print('Saved distilled checkpoint at', path)
+
+    fastnerf_path = os.path.join(basedir, expname, 'fastnerf_cache_{:06d}.tar'.format(start))
+    if args.bake_fastnerf:
+        print('BAKE FASTNERF CACHE')
+        cache = bake_fastnerf_cache(render_kwargs_test, args.fastnerf_budget_mb, args.fastnerf_dir_res, args.grid_bound)
+        print('Cache: position grid {}^3, direction grid {}^2, {:.1f} MB'.format(
+            cache.pos_grid.shape[0], cache.dir_grid.shape[0], cache.nbytes() / 2**20))
+
+        err = fastnerf_cache_error(cache, render_kwargs_test, dist=(far - near) / args.N_samples)
+        print('Cache vs network: |rgb| mean {rgb_mean:.4f} max {rgb_max:.4f}, |alpha| mean {alpha_mean:.4f} max {alpha_max:.4f}'.format(**err))
+        with torch.no_grad():
+            test_pose = torch.Tensor(poses[i_test[0]][:3,:4]).to(device)
+            render_factor = args.render_factor if args.render_factor > 0 else 4
+            live, _ = render_path([test_pose], hwf, K, args.chunk, render_kwargs_test, render_factor=render_factor)
+            cached, _ = render_path([test_pose], hwf, K, args.chunk, dict(render_kwargs_test, fastnerf_cache=cache), render_factor=render_factor)
+        print('Cache vs network PSNR on test view {}: {:.2f}'.format(i_test[0], mse2psnr(img2mse(torch.Tensor(live), torch.Tensor(cached))).item()))
+
+        torch.save({'bound' : cache.bound, 'cache_state_dict' : cache.state_dict()}, fastnerf_path)
+        print('Saved cache at', fastnerf_path)
+        return
+
+    if args.render_fastnerf:
+        assert os.path.exists(fastnerf_path), 'No cache baked for step {}, run with --bake_fastnerf first'.format(start)
+        render_kwargs_test['fastnerf_cache'] = load_fastnerf_cache(fastnerf_path)
+
+    octree_path = os.path.join(basedir, expname, 'octree_{:06d}'.format(start))
+    if args.bake_octree:
+        print('BAKE PLENOCTREE')
+        # Pruning rays: a random subset of pixels of every training view
+        rays = []
+        for i in i_train:
+            select = torch.randperm(H * W)[:args.octree_prune_rays]
+            c2w = torch.Tensor(poses[i, :3, :4]).to(device).expand(select.shape[0], 3, 4)
+            rays.append(torch.stack(get_rays_at(K, c2w, (select // W).float(), (select % W).float()), 0))
+        rays = torch.cat(rays, 1)
+        # View directions from the world-space rays, as in render()
+        viewdirs = rays[1] / torch.norm(rays[1], dim=-1, keepdim=True)
+        if render_kwargs_test.get('ndc', True):
+            rays = torch.stack(ndc_rays(H, W, K[0][0], 1., rays[0], rays[1]), 0)
+        rays = torch.cat([rays, viewdirs[None]], 0)
+
+        tree = bake_plenoctree(render_kwargs_test, rays, args.octree_depth, args.grid_bound, args.octree_sigma_thresh,
+                               args.octree_weight_thresh, args.octree_sh_degree, args.octree_n_dirs, args.chunk)
+        tree.save(octree_path)
+        print('Saved octree at {}: {} nodes, {} leaves, {:.1f} MB'.format(
+            octree_path, tree.child.shape[0], tree.n_leaves(), tree.nbytes() / 2**20))
+        return
+
+    if args.render_octree:
+        assert os.path.exists(octree_path), 'No octree baked for step {}, run with --bake_octree first'.format(start)
+        render_kwargs_test['octree'] = PlenOctree.load(octree_path, device=device)
+
+    if args.export_mesh:
+        print('EXPORT MESH')
+        mesh_path = os.path.join(basedir, expname, 'mesh_{:06d}.{}'.format(start, args.mesh_format))
+        export_mesh(render_kwargs_test, occupancy_density_fn(render_kwargs_test), mesh_path, args.mesh_res, args.grid_bound,
+                    args.mesh_thresh, args.mesh_block, args.mesh_coarse_stride, args.chunk)
+        print('Saved mesh at', mesh_path)
+        return
+
+    if args.render_progressive:
+        print('RENDER PROGRESSIVE')
+        testsavedir = os.path.join(basedir, expname, 'progressive_{:06d}'.format(start))
+        os.makedirs(testsavedir, exist_ok=True)
+        target = torch.Tensor(images[i_test[0]]).to(device)
+        with torch.no_grad():
+            frames = render_progressive(H, W, K, torch.Tensor(poses[i_test[0]]).to(device), args.chunk, render_kwargs_test,
+                                        args.progressive_budget, args.progressive_factor, args.progressive_sample_frac, args.progressive_tile)
+            for k, (rgb, disp, info) in enumerate(frames):
+                psnr = mse2psnr(img2mse(rgb, target)).item()
+                print('{:.3f}s factor {} tiles {}/{} PSNR {:.2f}'.format(
+                    info['elapsed'], info['factor'], info['tiles_done'], info['tiles_total'], psnr))
+                imageio.imwrite(os.path.join(testsavedir, '{:03d}.png'.format(k)), to8b(rgb.cpu().numpy()))
+        print('Saved frames at', testsavedir)
+        return
+
     # Short circuit if only rendering out from trained model
     if args.render_only:
         print('RENDER ONLY')
@@ -674,31 +1609,32 @@ def train():
     # Prepare raybatch tensor if batching random rays
     N_rand = args.N_rand
     use_batching = not args.no_batching
-    if use_batching:
-        # For random ray batching
-        print('get rays')
-        rays = np.stack([get_rays_np(H, W, K, p) for p in poses[:,:3,:4]], 0) # [N, ro+rd, H, W, 3]
-        print('done, concats')
-        rays_rgb = np.concatenate([rays, images[:,None]], 1) # [N, ro+rd+rgb, H, W, 3]
-        rays_rgb = np.transpose(rays_rgb, [0,2,3,1,4]) # [N, H, W, ro+rd+rgb, 3]
-        rays_rgb = np.stack([rays_rgb[i] for i in i_train], 0) # train images only
-        rays_rgb = np.reshape(rays_rgb, [-1,3,3]) # [(N-1)*H*W, ro+rd+rgb, 3]
-        rays_rgb = rays_rgb.astype(np.float32)
-        print('shuffle rays')
-        np.random.shuffle(rays_rgb)
-
-        print('done')
-        i_batch = 0
+    if use_batching and args.pixel_cache:
+        # Stream the training pixels from disk, the cache is rebuilt only if the images or poses changed
+        cache_dir = os.path.join(basedir, expname, 'pixel_cache')
+        if isinstance(images, LazyImages):
+            train_images, files = images.select(i_train), images.select(i_train).files
+        else:
+            train_images, files = [images[i] for i in i_train], dataset_files(args.datadir)
+        pixel_cache_key = pixel_cache_hash(files, {k : getattr(args, k) for k in
+            ['dataset_type', 'shape', 'factor', 'spherify', 'half_res', 'testskip', 'white_bkgd']})
+        if build_pixel_cache(cache_dir, pixel_cache_key, train_images, poses[i_train, :3, :4], K):
+            print('Built pixel cache at', cache_dir)
+        else:
+            print('Reusing pixel cache at', cache_dir)
+        ray_sampler = DiskRaySampler(cache_dir, device, args.pixel_cache_block, args.pixel_cache_prefetch)
+    elif use_batching:
+        # For random ray batching, rays are generated per batch from the uint8 training images.
+        # A list of views, images[i_train] would copy all training images as float32
+        ray_sampler = RaySampler([images[i] for i in i_train], poses[i_train, :3, :4], K, device)
 
     # Move training data to GPU
-    if use_batching:
-        images = torch.Tensor(images).to(device)
     poses = torch.Tensor(poses).to(device)
-    if use_batching:
-        rays_rgb = torch.Tensor(rays_rgb).to(device)
 
 
     N_iters = 200000 + 1
+
+    grid_schedule = get_grid_schedule(args)
     print('Begin')
     print('TRAIN views are', i_train)
     print('TEST views are', i_test)
@@ -708,53 +1644,24 @@ def train():
     # writer = SummaryWriter(os.path.join(basedir, 'summaries', expname))
     
     start = start + 1
+    if not use_batching:
+        # Random from one image, batches are prepared ahead by worker threads
+        batch_loader = BatchPrefetcher(images, poses.cpu().numpy(), K, i_train, N_rand, device, start,
+                                       args.precrop_iters, args.precrop_frac, args.prefetch_workers, args.prefetch_depth)
+        if args.precrop_iters > start:
+            dH, dW = int(H//2 * args.precrop_frac), int(W//2 * args.precrop_frac)
+            print(f"[Config] Center cropping of size {2*dH} x {2*dW} is enabled until iter {args.precrop_iters}")
+
     for i in trange(start, N_iters):
         time0 = time.time()
 
         # Sample random ray batch
         if use_batching:
             # Random over all images
-            batch = rays_rgb[i_batch:i_batch+N_rand] # [B, 2+1, 3*?]
-            batch = torch.transpose(batch, 0, 1)
-            batch_rays, target_s = batch[:2], batch[2]
-
-            i_batch += N_rand
-            if i_batch >= rays_rgb.shape[0]:
-                print("Shuffle data after an epoch!")
-                rand_idx = torch.randperm(rays_rgb.shape[0])
-                rays_rgb = rays_rgb[rand_idx]
-                i_batch = 0
+            batch_rays, target_s = ray_sampler.sample(N_rand)
 
         else:
-            # Random from one image
-            img_i = np.random.choice(i_train)
-            target = images[img_i]
-            target = torch.Tensor(target).to(device)
-            pose = poses[img_i, :3,:4]
-
-            if N_rand is not None:
-                rays_o, rays_d = get_rays(H, W, K, torch.Tensor(pose))  # (H, W, 3), (H, W, 3)
-
-                if i < args.precrop_iters:
-                    dH = int(H//2 * args.precrop_frac)
-                    dW = int(W//2 * args.precrop_frac)
-                    coords = torch.stack(
-                        torch.meshgrid(
-                            torch.linspace(H//2 - dH, H//2 + dH - 1, 2*dH), 
-                            torch.linspace(W//2 - dW, W//2 + dW - 1, 2*dW)
-                        ), -1)
-                    if i == start:
-                        print(f"[Config] Center cropping of size {2*dH} x {2*dW} is enabled until iter {args.precrop_iters}")                
-                else:
-                    coords = torch.stack(torch.meshgrid(torch.linspace(0, H-1, H), torch.linspace(0, W-1, W)), -1)  # (H, W, 2)
-
-                coords = torch.reshape(coords, [-1,2])  # (H * W, 2)
-                select_inds = np.random.choice(coords.shape[0], size=[N_rand], replace=False)  # (N_rand,)
-                select_coords = coords[select_inds].long()  # (N_rand, 2)
-                rays_o = rays_o[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-                rays_d = rays_d[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-                batch_rays = torch.stack([rays_o, rays_d], 0)
-                target_s = target[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
+            batch_rays, target_s = batch_loader.next()
 
         #####  Core optimization loop  #####
         rgb, disp, acc, extras = render(H, W, K, chunk=args.chunk, rays=batch_rays,
@@ -772,6 +1679,9 @@ def train():
             loss = loss + img_loss0
             psnr0 = mse2psnr(img_loss0)
 
+        if 'prop_loss' in extras:
+            loss = loss + args.prop_loss_mult * torch.mean(extras['prop_loss'])
+
         loss.backward()
         optimizer.step()
 
@@ -781,9 +1691,25 @@ def train():
         decay_steps = args.lrate_decay * 1000
         new_lrate = args.lrate * (decay_rate ** (global_step / decay_steps))
         for param_group in optimizer.param_groups:
-            param_group['lr'] = new_lrate
+            param_group['lr'] = new_lrate * param_group.get('lr_mult', 1.)
         ################################
 
+        if i in grid_schedule:
+            # Progressive growth: drop empty voxels, then upsample
+            model = render_kwargs_train['network_fn']
+            if hasattr(model, 'prune'):
+                active = model.prune(args.grid_prune_thresh)
+                tqdm.write(f"[TRAIN] Active voxels {active:.4f}")
+            old_params = list(model.parameters())
+            model.upsample(**grid_schedule[i])
+            replace_optimizer_params(optimizer, old_params, list(model.parameters()))
+            n_grid = sum(p.numel() for p in model.grid_parameters())
+            tqdm.write(f"[TRAIN] Upsampled {args.backend} to {grid_schedule[i]}, {n_grid} grid parameters")
+
+        occupancy_grid = render_kwargs_train['occupancy_grid']
+        if occupancy_grid is not None and i >= args.occ_warmup and i % args.occ_update_every == 0:
+            occupancy_grid.update(occupancy_density_fn(render_kwargs_train), int(args.occ_update_frac * args.occ_res**3))
+
         dt = time.time()-time0
         # print(f"Step: {global_step}, Loss: {loss}, Time: {dt}")
         #####           end            #####
@@ -791,12 +1717,15 @@ def train():
         # Rest is logging
         if i%args.i_weights==0:
             path = os.path.join(basedir, expname, '{:06d}.tar'.format(i))
-            torch.save({
+            ckpt = {
                 'global_step': global_step,
                 'network_fn_state_dict': render_kwargs_train['network_fn'].state_dict(),
-                'network_fine_state_dict': render_kwargs_train['network_fine'].state_dict(),
+                'network_fine_state_dict': render_kwargs_train['network_fine'].state_dict() if render_kwargs_train['network_fine'] is not None else None,
                 'optimizer_state_dict': optimizer.state_dict(),
-            }, path)
+            }
+            if render_kwargs_train['occupancy_grid'] is not None:
+                ckpt['occupancy_grid_state_dict'] = render_kwargs_train['occupancy_grid'].state_dict()
+            torch.save(ckpt, path)
             print('Saved checkpoints at', path)
 
         if i%args.i_video==0 and i > 0:
@@ -827,6 +1756,12 @@ def train():
     
         if i%args.i_print==0:
             tqdm.write(f"[TRAIN] Iter: {i} Loss: {loss.item()}  PSNR: {psnr.item()}")
+            if render_kwargs_train['occupancy_grid'] is not None:
+                tqdm.write(f"[TRAIN] Occupied cells: {render_kwargs_train['occupancy_grid'].occupied_fraction():.4f}")
+            if not use_batching:
+                n = batch_loader.n_batches
+                tqdm.write(f"[TRAIN] Batch wait {1000 * batch_loader.wait_time / n:.2f} ms/iter, "
+                           f"preparation {1000 * batch_loader.produce_time / n:.2f} ms/iter")
         """
             print(expname, i, psnr.numpy(), loss.numpy(), global_step.numpy())
             print('iter time {:.05f}'.format(dt))
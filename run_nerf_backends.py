@@ -0,0 +1,375 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from run_nerf_helpers import get_embedder, grid_cell_index, grid_cell_ijk
+
+
+# Explicit scene representations that can stand in for the NeRF MLP as
+# network_fn. They take raw xyz (i_embed=-1) plus embedded view directions and
+# expose the same forward/forward_factored/forward_density/forward_color
+# interface as NeRF, so run_network, deferred shading and render_rays work
+# unchanged.
+
+
+def grid_sample_3d(grid, pts, bound):
+    """Trilinearly samples grid [1, C, R, R, R] at pts [..., 3] in
+    [-bound, bound]^3. Returns [..., C], zeros outside the grid.
+    """
+    coords = (pts / bound).reshape(1, -1, 1, 1, 3)
+    out = F.grid_sample(grid, coords.to(grid.dtype), mode='bilinear', padding_mode='zeros', align_corners=True)
+    return out.reshape(grid.shape[1], -1).t().reshape(list(pts.shape[:-1]) + [grid.shape[1]])
+
+
+class _ExplicitField(nn.Module):
+    """Shared colour decoder: a per-sample feature h (+ view direction) goes
+    through a small MLP laid out like NeRF's views_linears. Subclasses store
+    their explicit parameters directly on the module and implement
+    forward_density(input_pts) -> (h, alpha) and grid_parameters().
+    """
+    def __init__(self, n_features, D, W, input_ch_views, use_viewdirs):
+        super(_ExplicitField, self).__init__()
+        self.W = n_features  # width of the per-sample feature fed to views_linears[0], as in NeRF
+        self.input_ch = 3
+        self.input_ch_views = input_ch_views if use_viewdirs else 0
+        self.use_viewdirs = use_viewdirs
+
+        self.views_linears = nn.ModuleList(
+            [nn.Linear(n_features + self.input_ch_views, W)] + [nn.Linear(W, W) for i in range(D-1)])
+        self.rgb_linear = nn.Linear(W, 3)
+
+    def forward_views(self, input_views):
+        l = self.views_linears[0]
+        return F.linear(input_views, l.weight[:, self.W:], l.bias)
+
+    def forward_color(self, h, views_term):
+        h = F.linear(h, self.views_linears[0].weight[:, :self.W]) + views_term
+        h = F.relu(h)
+        for l in self.views_linears[1:]:
+            h = F.relu(l(h))
+        return self.rgb_linear(h)
+
+    def forward_factored(self, input_pts, views_term):
+        h, alpha = self.forward_density(input_pts)
+        rgb = self.forward_color(h, views_term[:, None])
+        return torch.cat([rgb, alpha], -1)
+
+    def forward(self, x):
+        input_pts, input_views = torch.split(x, [self.input_ch, x.shape[-1] - self.input_ch], dim=-1)
+        h, alpha = self.forward_density(input_pts)
+        if self.use_viewdirs:
+            views_term = self.forward_views(input_views)
+        else:
+            views_term = self.views_linears[0].bias
+        rgb = self.forward_color(h, views_term)
+        return torch.cat([rgb, alpha], -1)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints may have been saved after upsampling, so take their shapes
+        for name, t in list(self._parameters.items()) + list(self._buffers.items()):
+            key = prefix + name
+            if t is None or key not in state_dict or state_dict[key].shape == t.shape:
+                continue
+            resized = torch.empty(state_dict[key].shape, dtype=t.dtype, device=t.device)
+            if name in self._parameters:
+                self._parameters[name] = nn.Parameter(resized)
+            else:
+                self._buffers[name] = resized
+        self._sync_shapes()
+        super(_ExplicitField, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _sync_shapes(self):
+        pass
+
+
+# Dense voxel grid (DVGO / Plenoxels style)
+class VoxelGridNeRF(_ExplicitField):
+    def __init__(self, resolution=64, bound=1.5, n_features=12, D=2, W=128, input_ch_views=3, use_viewdirs=False, density_init=0.1):
+        """Density and color features stored in dense [R, R, R] grids, sampled
+        trilinearly, with a small MLP decoding features (+ view direction) to rgb.
+        """
+        super(VoxelGridNeRF, self).__init__(n_features, D, W, input_ch_views, use_viewdirs)
+        self.resolution = resolution
+        self.bound = bound
+
+        self.density = nn.Parameter(torch.full([1, 1] + [resolution]*3, density_init))
+        self.features = nn.Parameter(torch.zeros([1, n_features] + [resolution]*3))
+        # Voxels removed by prune(), kept at zero density
+        self.register_buffer('mask', torch.ones([1, 1] + [resolution]*3))
+
+    def grid_parameters(self):
+        return [self.density, self.features]
+
+    def forward_density(self, input_pts):
+        h = grid_sample_3d(self.features, input_pts, self.bound)
+        alpha = grid_sample_3d(self.density * self.mask, input_pts, self.bound)
+        return h, alpha
+
+    @torch.no_grad()
+    def upsample(self, resolution):
+        """Trilinearly resamples the grids to resolution^3. The grids become new
+        Parameters, see replace_optimizer_params().
+        """
+        size = [resolution]*3
+        self.density = nn.Parameter(F.interpolate(self.density, size=size, mode='trilinear', align_corners=True))
+        self.features = nn.Parameter(F.interpolate(self.features, size=size, mode='trilinear', align_corners=True))
+        self.mask = (F.interpolate(self.mask, size=size, mode='trilinear', align_corners=True) > 0).to(self.mask.dtype)
+        self.resolution = resolution
+
+    @torch.no_grad()
+    def prune(self, thresh):
+        """Masks out voxels whose density and all of whose neighbours' densities
+        are below thresh. Returns the fraction of voxels still active.
+        """
+        occupied = (F.relu(self.density * self.mask) > thresh).to(self.mask.dtype)
+        occupied = F.max_pool3d(occupied, kernel_size=3, stride=1, padding=1)
+        self.mask.mul_(occupied)
+        self.features.data.mul_(self.mask)
+        return self.mask.mean().item()
+
+    def _sync_shapes(self):
+        self.resolution = self.density.shape[-1]
+
+
+# Vector-matrix factorization (TensoRF VM)
+class TensoRFNeRF(_ExplicitField):
+    # Each component pairs a plane over two axes with a line along the third
+    mat_ids = [[0, 1], [0, 2], [1, 2]]
+    vec_ids = [2, 1, 0]
+
+    def __init__(self, resolution=128, bound=1.5, density_rank=16, app_rank=48, n_features=27, D=2, W=128, input_ch_views=3, use_viewdirs=False, init_scale=0.1):
+        """Density is the sum of density_rank plane x line products per axis;
+        appearance concatenates app_rank products per axis and projects them to
+        n_features with a linear basis before the colour decoder. Storage is
+        O(rank * R^2) instead of the O(R^3) of a dense grid.
+        """
+        super(TensoRFNeRF, self).__init__(n_features, D, W, input_ch_views, use_viewdirs)
+        self.resolution = resolution
+        self.bound = bound
+        self.init_scale = init_scale
+
+        self.density_plane = nn.Parameter(init_scale * torch.randn([3, density_rank, resolution, resolution]))
+        self.density_line = nn.Parameter(init_scale * torch.randn([3, density_rank, resolution, 1]))
+        self.app_plane = nn.Parameter(init_scale * torch.randn([3, app_rank, resolution, resolution]))
+        self.app_line = nn.Parameter(init_scale * torch.randn([3, app_rank, resolution, 1]))
+        self.basis = nn.Linear(3 * app_rank, n_features, bias=False)
+
+    @property
+    def density_rank(self):
+        return self.density_plane.shape[1]
+
+    @property
+    def app_rank(self):
+        return self.app_plane.shape[1]
+
+    def grid_parameters(self):
+        return [self.density_plane, self.density_line, self.app_plane, self.app_line]
+
+    def _components(self, plane, line, coord_plane, coord_line):
+        """plane/line products for all 3 axes at once. Returns [3, rank, N]."""
+        plane_feat = F.grid_sample(plane, coord_plane, mode='bilinear', align_corners=True)
+        line_feat = F.grid_sample(line, coord_line, mode='bilinear', align_corners=True)
+        return (plane_feat * line_feat)[..., 0]
+
+    def forward_density(self, input_pts):
+        sh = input_pts.shape[:-1]
+        xyz = (input_pts / self.bound).reshape(-1, 3)
+        coord_plane = torch.stack([xyz[:, ids] for ids in self.mat_ids], 0)[:, :, None]  # [3, N, 1, 2]
+        coord_line = xyz[:, self.vec_ids].t()[..., None]
+        coord_line = torch.stack([torch.zeros_like(coord_line), coord_line], -1)  # [3, N, 1, 2]
+
+        alpha = self._components(self.density_plane, self.density_line, coord_plane, coord_line).sum((0, 1))
+        app = self._components(self.app_plane, self.app_line, coord_plane, coord_line)
+        h = self.basis(app.reshape(-1, app.shape[-1]).t())
+        return h.reshape(list(sh) + [-1]), alpha.reshape(list(sh) + [1])
+
+    @torch.no_grad()
+    def upsample(self, resolution, density_rank=None, app_rank=None):
+        """Bilinearly resamples planes and lines to resolution and appends
+        components up to the given ranks. New components start with one zero
+        factor (or zero basis columns), so the field is unchanged. The factors
+        become new Parameters (as may basis.weight), see replace_optimizer_params().
+        """
+        density_rank = density_rank or self.density_rank
+        app_rank = app_rank or self.app_rank
+        size_plane, size_line = [resolution, resolution], [resolution, 1]
+        density_plane = F.interpolate(self.density_plane, size=size_plane, mode='bilinear', align_corners=True)
+        density_line = F.interpolate(self.density_line, size=size_line, mode='bilinear', align_corners=True)
+        app_plane = F.interpolate(self.app_plane, size=size_plane, mode='bilinear', align_corners=True)
+        app_line = F.interpolate(self.app_line, size=size_line, mode='bilinear', align_corners=True)
+
+        n = density_rank - self.density_rank
+        if n > 0:
+            density_plane = torch.cat([density_plane, self.init_scale * torch.randn_like(density_plane[:, :n])], 1)
+            density_line = torch.cat([density_line, torch.zeros_like(density_line[:, :n])], 1)
+        n = app_rank - self.app_rank
+        if n > 0:
+            app_plane = torch.cat([app_plane, self.init_scale * torch.randn_like(app_plane[:, :n])], 1)
+            app_line = torch.cat([app_line, self.init_scale * torch.randn_like(app_line[:, :n])], 1)
+            weight = self.basis.weight.reshape(self.W, 3, -1)
+            weight = torch.cat([weight, torch.zeros_like(weight[..., :n])], -1)
+            self.basis.weight = nn.Parameter(weight.reshape(self.W, -1))
+
+        self.density_plane = nn.Parameter(density_plane)
+        self.density_line = nn.Parameter(density_line)
+        self.app_plane = nn.Parameter(app_plane)
+        self.app_line = nn.Parameter(app_line)
+        self.resolution = resolution
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        key = prefix + 'basis.weight'
+        if key in state_dict and state_dict[key].shape != self.basis.weight.shape:
+            self.basis.weight = nn.Parameter(torch.empty_like(state_dict[key]))
+        super(TensoRFNeRF, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _sync_shapes(self):
+        self.resolution = self.density_plane.shape[-1]
+
+
+# Spatial decomposition into many tiny MLPs (KiloNeRF)
+class KiloNeRF(nn.Module):
+    def __init__(self, grid_res=16, bound=1.5, multires=10, D=2, W=32, input_ch_views=3, use_viewdirs=False, block_size=None):
+        """One tiny MLP per cell of a grid_res^3 grid over [-bound, bound]^3.
+        Samples are bucketed by cell into blocks of block_size rows and every
+        layer is a single torch.baddbmm over the blocks' gathered weights.
+        block_size=None picks the power of two closest to the mean number of
+        samples per occupied cell, which bounds the padding per cell.
+        Positions are encoded inside the model, so it expects raw xyz (i_embed=-1).
+        """
+        super(KiloNeRF, self).__init__()
+        self.grid_res = grid_res
+        self.bound = bound
+        self.block_size = block_size
+        self.input_ch = 3
+        self.input_ch_views = input_ch_views if use_viewdirs else 0
+        self.use_viewdirs = use_viewdirs
+        self.embed_fn, input_ch_pts = get_embedder(multires)
+
+        # Per-cell layers, stored as [n_cells, in, out] / [n_cells, out]
+        C = grid_res**3
+        self.pts_dims = [input_ch_pts] + [W]*D
+        self.pts_weights = nn.ParameterList([self._init_weight(C, i, o) for i, o in zip(self.pts_dims[:-1], self.pts_dims[1:])])
+        self.pts_biases = nn.ParameterList([self._init_bias(C, i, o) for i, o in zip(self.pts_dims[:-1], self.pts_dims[1:])])
+        self.alpha_weight, self.alpha_bias = self._init_weight(C, W, 1), self._init_bias(C, W, 1)
+        self.feature_weight, self.feature_bias = self._init_weight(C, W, W), self._init_bias(C, W, W)
+        self.views_weight, self.views_bias = self._init_weight(C, W + self.input_ch_views, W), self._init_bias(C, W + self.input_ch_views, W)
+        self.rgb_weight, self.rgb_bias = self._init_weight(C, W, 3), self._init_bias(C, W, 3)
+        # Cells found empty by prune_cells() are never evaluated
+        self.register_buffer('cell_mask', torch.ones([C], dtype=torch.bool))
+
+    @staticmethod
+    def _init_weight(C, fan_in, fan_out):
+        # Same range as nn.Linear's default init
+        return nn.Parameter(torch.empty([C, fan_in, fan_out]).uniform_(-fan_in**-.5, fan_in**-.5))
+
+    @staticmethod
+    def _init_bias(C, fan_in, fan_out):
+        return nn.Parameter(torch.empty([C, fan_out]).uniform_(-fan_in**-.5, fan_in**-.5))
+
+    def cell_index(self, pts):
+        """Flat cell index of each point, -1 for points outside the grid."""
+        return grid_cell_index(pts, self.bound, self.grid_res)
+
+    def _block_layout(self, cell):
+        """Assigns each sample a (block, slot) so that every block holds
+        samples of a single cell. Returns block_id, slot, block_cell and the
+        block size.
+        """
+        counts = torch.bincount(cell, minlength=self.grid_res**3)
+        B = self.block_size
+        if B is None:
+            mean = cell.shape[0] / max(1, (counts > 0).sum().item())
+            B = int(2**min(8, max(3, round(math.log2(mean)))))
+        blocks_per_cell = (counts + B - 1) // B
+        block_start = torch.cumsum(blocks_per_cell, 0) - blocks_per_cell
+        cell_start = torch.cumsum(counts, 0) - counts
+
+        cell_sorted, order = torch.sort(cell)
+        rank = torch.arange(cell.shape[0], device=cell.device) - cell_start[cell_sorted]
+        block_id = torch.empty_like(cell)
+        slot = torch.empty_like(cell)
+        block_id[order] = block_start[cell_sorted] + torch.div(rank, B, rounding_mode='floor')
+        slot[order] = rank % B
+        block_cell = torch.repeat_interleave(torch.arange(counts.shape[0], device=cell.device), blocks_per_cell)
+        return block_id, slot, block_cell, B
+
+    @staticmethod
+    def _grouped_linear(x, weight, bias, block_cell):
+        # x: [n_blocks, block_size, in] -> [n_blocks, block_size, out]
+        return torch.baddbmm(bias[block_cell][:, None], x, weight[block_cell])
+
+    def forward(self, x):
+        input_pts, input_views = torch.split(x, [self.input_ch, x.shape[-1] - self.input_ch], dim=-1)
+        cell = self.cell_index(input_pts)
+        valid = (cell >= 0) & self.cell_mask[cell.clamp(min=0)]
+        idx = torch.nonzero(valid, as_tuple=True)[0]
+
+        outputs = torch.zeros([x.shape[0], 4], dtype=x.dtype, device=x.device)
+        if idx.shape[0] == 0:
+            return outputs
+
+        block_id, slot, block_cell, B = self._block_layout(cell[idx])
+        def to_blocks(t):
+            blocks = torch.zeros([block_cell.shape[0], B, t.shape[-1]], dtype=t.dtype, device=t.device)
+            blocks[block_id, slot] = t
+            return blocks
+
+        h = to_blocks(self.embed_fn(input_pts[idx]))
+        for w, b in zip(self.pts_weights, self.pts_biases):
+            h = F.relu(self._grouped_linear(h, w, b, block_cell))
+        alpha = self._grouped_linear(h, self.alpha_weight, self.alpha_bias, block_cell)
+        h = self._grouped_linear(h, self.feature_weight, self.feature_bias, block_cell)
+        if self.use_viewdirs:
+            h = torch.cat([h, to_blocks(input_views[idx])], -1)
+        h = F.relu(self._grouped_linear(h, self.views_weight, self.views_bias, block_cell))
+        rgb = self._grouped_linear(h, self.rgb_weight, self.rgb_bias, block_cell)
+
+        outputs[idx] = torch.cat([rgb, alpha], -1)[block_id, slot]
+        return outputs
+
+    def random_points(self, n):
+        """n points drawn uniformly from the cells not pruned by prune_cells()."""
+        R = self.grid_res
+        active = torch.nonzero(self.cell_mask, as_tuple=True)[0]
+        cells = active[torch.randint(active.shape[0], [n], device=active.device)]
+        ijk = grid_cell_ijk(cells, R)
+        return (ijk + torch.rand([n, 3], device=ijk.device)) / R * (2.*self.bound) - self.bound
+
+    @torch.no_grad()
+    def prune_cells(self, density_fn, thresh, n_per_axis=4):
+        """Marks cells as empty if density_fn (pts [N, 3] -> raw sigma [N]) is
+        below thresh at every point of a jittered n_per_axis^3 lattice inside
+        them. Returns the fraction of cells kept.
+        """
+        R, n = self.grid_res, n_per_axis
+        device = self.cell_mask.device
+        sub = torch.stack(torch.meshgrid(*[torch.arange(n, device=device)]*3, indexing='ij'), -1).reshape(-1, 3)
+        for c in range(0, R**3, R*R):
+            cells = torch.arange(c, min(c + R*R, R**3), device=device)
+            ijk = grid_cell_ijk(cells, R)
+            pts = ijk[:, None] * n + sub[None] + torch.rand([cells.shape[0], sub.shape[0], 3], device=device)
+            pts = pts / (R * n) * (2.*self.bound) - self.bound
+            sigma = F.relu(density_fn(pts.reshape(-1, 3))).reshape(cells.shape[0], -1)
+            self.cell_mask[cells] = sigma.max(-1)[0] > thresh
+        return self.cell_mask.float().mean().item()
+
+
+def grid_upsample_schedule(res_init, res_final, upsample_iters):
+    """Maps each iteration in upsample_iters to its target resolution, growing
+    geometrically from res_init to res_final.
+    """
+    n = len(upsample_iters)
+    return {it : int(round(res_init * (res_final / res_init)**((k+1) / n))) for k, it in enumerate(upsample_iters)}
+
+
+def replace_optimizer_params(optimizer, old_params, new_params):
+    """Points optimizer at new_params in place of old_params (e.g. around
+    VoxelGridNeRF.upsample()), dropping the stale moments of the old ones.
+    """
+    swap = {id(p) : q for p, q in zip(old_params, new_params)}
+    for group in optimizer.param_groups:
+        group['params'] = [swap.get(id(p), p) for p in group['params']]
+    for p in old_params:
+        optimizer.state.pop(p, None)
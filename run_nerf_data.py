@@ -0,0 +1,358 @@
+import os
+import time
+import json
+import queue
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from run_nerf_helpers import get_rays_at
+
+
+# Training ray sampling. Instead of materializing rays_o, rays_d and rgb for
+# every training pixel, only the images (uint8) and camera poses are kept and
+# the rays of each batch are generated on demand. For captures whose pixels do
+# not fit in memory they can be streamed from an on-disk cache instead.
+
+
+class LazyImages:
+    """Stand-in for a float32 [N, H, W, C] image array that decodes
+    load_fn(files[i]) only when an image is indexed: images[i] decodes one
+    file, images[idx] for an index array or slice stacks the selected ones.
+    shape, len() and files need no decoding.
+    """
+    def __init__(self, files, load_fn, shape):
+        self.files = list(files)
+        self.load_fn = load_fn
+        self.shape = tuple(shape)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self.load_fn(self.files[idx])
+        return np.stack([self.load_fn(self.files[i]) for i in np.arange(len(self))[idx]], 0)
+
+    def map(self, fn, channels):
+        """Applies fn [H, W, C] -> [H, W, channels] to every image on access."""
+        load_fn = self.load_fn
+        return LazyImages(self.files, lambda f : fn(load_fn(f)), self.shape[:-1] + (channels,))
+
+    def select(self, idx):
+        """The images idx, still undecoded."""
+        return LazyImages([self.files[i] for i in np.arange(len(self))[idx]], self.load_fn,
+                          (len(np.arange(len(self))[idx]),) + self.shape[1:])
+
+
+def to_uint8(images):
+    """Float images in [0, 1] -> uint8, rounded to the nearest level."""
+    return np.clip(np.round(np.asarray(images) * 255.), 0, 255).astype(np.uint8)
+
+
+class RaySampler:
+    """Random ray batches over all pixels of all training images, in
+    shuffled epochs like the materialized rays_rgb tensor, but storing only
+    the uint8 images [N, H, W, 3] and poses [N, 3, 4]. images can be any
+    sequence of float images (e.g. views into the full array, or a
+    LazyImages), they are converted one at a time into the uint8 array.
+
+    An epoch walks a permutation of the global pixel indices, kept on the
+    CPU as int32 where possible; only each batch's slice is moved to the
+    device. The next epoch's permutation is drawn in a background thread
+    while the current one is being used.
+    """
+    def __init__(self, images, poses, K, device):
+        self.N = len(images)
+        self.H, self.W = images[0].shape[:2]
+        self.images = torch.empty([self.N, self.H, self.W, 3], dtype=torch.uint8, device=device)
+        for i in range(self.N):
+            self.images[i] = torch.from_numpy(to_uint8(images[i][..., :3]))
+        self.poses = torch.Tensor(poses)
+        self.K = K
+        self.device = device
+        self.n_pixels = self.N * self.H * self.W
+
+        # Own generator, so the background thread does not race the global one
+        self.generator = torch.Generator().manual_seed(int(torch.randint(2**62, [1]).item()))
+        self.index_dtype = torch.int32 if self.n_pixels < 2**31 else torch.int64
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.perm = self._permutation()
+        self.next_perm = self.executor.submit(self._permutation)
+        self.i_batch = 0
+
+    def _permutation(self):
+        return torch.randperm(self.n_pixels, generator=self.generator, dtype=self.index_dtype, device='cpu')
+
+    def sample(self, N_rand):
+        """Returns batch_rays [2, N_rand, 3] and target_s [N_rand, 3]."""
+        idx = self.perm[self.i_batch:self.i_batch+N_rand].to(self.device, non_blocking=True).long()
+        self.i_batch += N_rand
+        if self.i_batch >= self.n_pixels:
+            print("Shuffle data after an epoch!")
+            self.perm = self.next_perm.result()
+            self.next_perm = self.executor.submit(self._permutation)
+            self.i_batch = 0
+        return self.rays(idx)
+
+    def rays(self, idx):
+        """Rays and colors of global pixel indices idx [B] into [N, H, W]."""
+        img_i, pix_y, pix_x = split_pixel_index(idx, self.H, self.W)
+        rays_o, rays_d = get_rays_at(self.K, self.poses[img_i], pix_y.float(), pix_x.float())
+        target_s = self.images[img_i, pix_y, pix_x].float() / 255.
+        return torch.stack([rays_o, rays_d], 0), target_s
+
+
+def split_pixel_index(idx, H, W):
+    """Global pixel indices into [N, H, W] -> image, row, column."""
+    return idx // (H * W), idx // W % H, idx % W
+
+
+# On-disk pixel cache: a directory with
+#   meta.json    N, H, W, K, pixel count, index dtype and the cache key
+#   poses.npy    [N, 3, 4] float32
+#   rgb.u8       [N*H*W, 3] uint8 pixel colors, in one fixed random order
+#   index.i32    [N*H*W] global pixel index of every rgb entry (index.i64 if
+#                there are 2**31 pixels or more)
+# The pixels are dealt into buckets of about block pixels, each holding an
+# equal share of every image, and every bucket is shuffled. Any contiguous
+# block is then a random sample of the dataset and can be read with
+# sequential I/O.
+
+
+def pixel_cache_hash(files, settings):
+    """Hash of the path, size and mtime of every file in files (the image
+    and pose files the loader reads) and of the loader settings (a
+    json-serializable dict). Reads no image.
+    """
+    h = hashlib.sha1(json.dumps(settings, sort_keys=True).encode())
+    for path in files:
+        st = os.stat(path)
+        h.update('{} {} {}\n'.format(os.path.abspath(path), st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+def dataset_files(datadir):
+    """Every file under datadir, for loaders that cannot list the files they
+    read up front.
+    """
+    files = []
+    for root, dirs, names in os.walk(datadir):
+        dirs.sort()
+        files += [os.path.join(root, name) for name in sorted(names)]
+    return files
+
+
+def pixel_cache_index_file(index_dtype):
+    return 'index.i32' if np.dtype(index_dtype) == np.int32 else 'index.i64'
+
+
+def build_pixel_cache(cache_dir, source_hash, images, poses, K, block=2**16):
+    """Writes the pixel cache of images [N][H, W, 3+] (float, [0, 1]; any
+    sequence, e.g. LazyImages, accessed one image at a time) and poses
+    [N, 3, 4] to cache_dir, unless one with the same source_hash (see
+    pixel_cache_hash()), poses and K is already there. A reused cache never
+    touches images. Returns True if the cache was (re)built.
+    """
+    h = hashlib.sha1(source_hash.encode())
+    h.update(np.asarray(K, dtype=np.float64).tobytes())
+    h.update(np.asarray(poses, dtype=np.float32).tobytes())
+    digest = h.hexdigest()
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f)['hash'] == digest:
+                return False
+        # An interrupted rebuild must not leave the old cache looking complete
+        os.remove(meta_path)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    N = len(images)
+    H, W = images.shape[1:3] if hasattr(images, 'shape') else images[0].shape[:2]
+    P = N * H * W
+    index_dtype = np.int32 if P < 2**31 else np.int64
+    for old in ['index.i32', 'index.i64']:
+        if os.path.exists(os.path.join(cache_dir, old)):
+            os.remove(os.path.join(cache_dir, old))
+    rgb = np.memmap(os.path.join(cache_dir, 'rgb.u8'), dtype=np.uint8, mode='w+', shape=(P, 3))
+    index = np.memmap(os.path.join(cache_dir, pixel_cache_index_file(index_dtype)), dtype=index_dtype, mode='w+', shape=(P,))
+
+    # Pixel g of the stream (images in order, each one shuffled) goes to
+    # bucket g % n_buckets, so every bucket gets the same share of each image
+    n_buckets = max(1, P // block)
+    sizes = P // n_buckets + (np.arange(n_buckets) < P % n_buckets)
+    starts = np.concatenate([[0], np.cumsum(sizes)])
+    rng = np.random.default_rng()
+    for i in range(N):
+        perm = rng.permutation(H * W)
+        g = i * H * W + np.arange(H * W)
+        pos = starts[g % n_buckets] + g // n_buckets
+        rgb[pos] = to_uint8(images[i][..., :3]).reshape(-1, 3)[perm]
+        index[pos] = i * H * W + perm
+
+    for b in range(n_buckets):
+        s = slice(starts[b], starts[b+1])
+        perm = rng.permutation(sizes[b])
+        rgb[s] = rgb[s][perm]
+        index[s] = index[s][perm]
+    rgb.flush()
+    index.flush()
+    del rgb, index
+
+    np.save(os.path.join(cache_dir, 'poses.npy'), np.asarray(poses, dtype=np.float32))
+    # meta.json goes last and marks the cache as complete
+    with open(meta_path, 'w') as f:
+        json.dump({'hash' : digest, 'N' : N, 'H' : H, 'W' : W, 'n_pixels' : P,
+                   'index_dtype' : np.dtype(index_dtype).name,
+                   'K' : np.asarray(K, dtype=np.float64).tolist()}, f)
+    return True
+
+
+class DiskRaySampler:
+    """RaySampler over a pixel cache built by build_pixel_cache(). An epoch
+    visits the cache's blocks of block_size pixels in a random order and
+    shuffles the pixels within each block; a thread reads up to prefetch
+    blocks ahead.
+    """
+    def __init__(self, cache_dir, device, block_size=2**16, prefetch=8):
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.H, self.W, self.K = meta['H'], meta['W'], meta['K']
+        self.n_pixels = meta['n_pixels']
+        index_dtype = np.dtype(meta.get('index_dtype', 'int64'))
+        self.poses = torch.Tensor(np.load(os.path.join(cache_dir, 'poses.npy')))
+        self.rgb = np.memmap(os.path.join(cache_dir, 'rgb.u8'), dtype=np.uint8, mode='r', shape=(self.n_pixels, 3))
+        self.index = np.memmap(os.path.join(cache_dir, pixel_cache_index_file(index_dtype)), dtype=index_dtype, mode='r',
+                               shape=(self.n_pixels,))
+        self.device = device
+        self.block_size = block_size
+        self.n_blocks = (self.n_pixels + block_size - 1) // block_size
+
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.buffer_idx = torch.from_numpy(np.zeros([0], dtype=index_dtype))
+        self.buffer_rgb = torch.zeros([0, 3], dtype=torch.uint8, device='cpu')
+        self.thread = threading.Thread(target=self._reader, args=(np.random.randint(2**31),), daemon=True)
+        self.thread.start()
+
+    def _reader(self, seed):
+        rng = np.random.RandomState(seed)
+        while True:
+            for b in rng.permutation(self.n_blocks):
+                s = slice(b * self.block_size, (b + 1) * self.block_size)
+                idx, rgb = np.array(self.index[s]), np.array(self.rgb[s])
+                # Blocks come back every epoch, so do not serve them in the stored order
+                perm = rng.permutation(idx.shape[0])
+                self.queue.put((torch.from_numpy(idx[perm]), torch.from_numpy(rgb[perm])))
+            self.queue.put(None)
+
+    def sample(self, N_rand):
+        """Returns batch_rays [2, N_rand, 3] and target_s [N_rand, 3]."""
+        idx, rgb = [self.buffer_idx], [self.buffer_rgb]
+        n = self.buffer_idx.shape[0]
+        while n < N_rand:
+            block = self.queue.get()
+            if block is None:
+                print("Shuffle data after an epoch!")
+                continue
+            idx.append(block[0])
+            rgb.append(block[1])
+            n += block[0].shape[0]
+        idx, rgb = torch.cat(idx, 0), torch.cat(rgb, 0)
+        self.buffer_idx, self.buffer_rgb = idx[N_rand:], rgb[N_rand:]
+
+        idx = idx[:N_rand].to(self.device, non_blocking=True).long()
+        img_i, pix_y, pix_x = split_pixel_index(idx, self.H, self.W)
+        rays_o, rays_d = get_rays_at(self.K, self.poses[img_i], pix_y.float(), pix_x.float())
+        target_s = rgb[:N_rand].to(self.device, non_blocking=True).float() / 255.
+        return torch.stack([rays_o, rays_d], 0), target_s
+
+
+class BatchPrefetcher:
+    """--no_batching batches (N_rand random pixels of one random training
+    image, from the central crop for the first precrop_iters iterations),
+    prepared by n_workers threads up to queue_depth batches ahead of the
+    training loop. With n_workers=0 batches are made on demand.
+
+    Batches are returned in the order they were claimed, whichever worker
+    finishes first, so the switch away from the precrop happens at exactly
+    precrop_iters.
+
+    wait_time is the time next() spent blocked, produce_time the total time
+    spent making batches; their difference is the time hidden by the workers.
+    """
+    def __init__(self, images, poses, K, i_train, N_rand, device, start=0, precrop_iters=0, precrop_frac=.5,
+                 n_workers=2, queue_depth=4):
+        self.images = images
+        self.poses = torch.Tensor(np.asarray(poses)[:, :3, :4]).to(device)
+        self.K = K
+        self.i_train = np.asarray(i_train)
+        self.N_rand = N_rand
+        self.device = device
+        self.start = start
+        self.precrop_iters = precrop_iters
+        self.precrop_frac = precrop_frac
+
+        self.wait_time, self.produce_time, self.n_batches = 0., 0., 0
+        self.lock = threading.Lock()
+        self.next_k = 0
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.pending = {}
+        self.rng = np.random.default_rng(np.random.randint(2**31))
+        self.workers = [threading.Thread(target=self._worker, args=(self.rng.integers(2**31),), daemon=True)
+                        for _ in range(n_workers)]
+        for w in self.workers:
+            w.start()
+
+    def _make_batch(self, k, rng):
+        t = time.time()
+        img_i = rng.choice(self.i_train)
+        H, W = self.images[img_i].shape[:2]
+        if self.start + k < self.precrop_iters:
+            dH, dW = int(H//2 * self.precrop_frac), int(W//2 * self.precrop_frac)
+            y0, x0, h, w = H//2 - dH, W//2 - dW, 2*dH, 2*dW
+        else:
+            y0, x0, h, w = 0, 0, H, W
+        select = rng.choice(h * w, size=self.N_rand, replace=False)
+        pix_y, pix_x = select // w + y0, select % w + x0
+
+        target_s = torch.Tensor(self.images[img_i][pix_y, pix_x, :3]).to(self.device)
+        pix_y, pix_x = torch.Tensor(pix_y).to(self.device), torch.Tensor(pix_x).to(self.device)
+        rays_o, rays_d = get_rays_at(self.K, self.poses[img_i].expand(self.N_rand, 3, 4), pix_y, pix_x)
+        batch = torch.stack([rays_o, rays_d], 0), target_s
+
+        with self.lock:
+            self.produce_time += time.time() - t
+        return batch
+
+    def _worker(self, seed):
+        rng = np.random.default_rng(seed)
+        while True:
+            with self.lock:
+                k = self.next_k
+                self.next_k += 1
+            try:
+                self.queue.put((k, self._make_batch(k, rng)))
+            except Exception as e:
+                # Hand the error to the training loop instead of leaving it waiting
+                self.queue.put((k, e))
+                return
+
+    def next(self):
+        """Returns batch_rays [2, N_rand, 3] and target_s [N_rand, 3]."""
+        t = time.time()
+        if self.workers:
+            # Workers finish out of order, hold on to batches that arrive early
+            while self.n_batches not in self.pending:
+                k, batch = self.queue.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                self.pending[k] = batch
+            batch = self.pending.pop(self.n_batches)
+        else:
+            batch = self._make_batch(self.n_batches, self.rng)
+        self.wait_time += time.time() - t
+        self.n_batches += 1
+        return batch
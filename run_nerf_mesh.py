@@ -0,0 +1,204 @@
+import sys
+import time
+import resource
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+
+# Mesh export: the density field is evaluated on a res^3 lattice over
+# [-bound, bound]^3 one block at a time, so memory stays bounded by the block
+# size rather than the lattice. Neighbouring blocks share one layer of samples,
+# which makes marching cubes produce identical vertices on their common faces;
+# these are welded when the blocks are stitched together.
+
+
+def marching_cubes(volume, level):
+    """volume [X, Y, Z] numpy -> verts [V, 3] in index space, faces [F, 3].
+    Uses scikit-image, or PyMCubes if scikit-image is not installed.
+    """
+    try:
+        from skimage.measure import marching_cubes as mc
+        verts, faces, _, _ = mc(volume, level)
+        return verts, faces
+    except ImportError:
+        pass
+    try:
+        import mcubes
+    except ImportError:
+        raise ImportError('Mesh export needs scikit-image or PyMCubes (pip install scikit-image)')
+    return mcubes.marching_cubes(volume, level)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def lattice_points(lo, hi, res, bound):
+    """World positions [*(hi - lo), 3] of lattice indices lo <= ijk < hi."""
+    axes = [torch.arange(lo[d], hi[d], dtype=torch.float32) / (res - 1) * 2. * bound - bound for d in range(3)]
+    return torch.stack(torch.meshgrid(*axes, indexing='ij'), -1)
+
+
+def coarse_block_mask(density_fn, res, bound, block, thresh, stride, chunk=1024*64):
+    """Pre-pass on every stride-th lattice sample. Returns a bool [nb, nb, nb]
+    that is False for blocks with no coarse sample above thresh in or next to
+    them, and the number of points evaluated. Structures thinner than stride
+    samples can be missed.
+    """
+    idx = torch.arange(0, res, stride)
+    Rc = idx.shape[0]
+    occ = torch.zeros([Rc**3], dtype=torch.bool)
+    t = idx.float() / (res - 1) * 2. * bound - bound
+    pts = torch.stack(torch.meshgrid(t, t, t, indexing='ij'), -1).reshape(-1, 3)
+    for i in range(0, pts.shape[0], chunk):
+        occ[i:i+chunk] = density_fn(pts[i:i+chunk]) > thresh
+    # Dilate by one coarse cell so surfaces between coarse samples are kept
+    occ = F.max_pool3d(occ.reshape(1, 1, Rc, Rc, Rc).float(), 3, stride=1, padding=1)[0, 0] > 0
+
+    nb = (res - 2) // block + 1
+    mask = torch.zeros([nb, nb, nb], dtype=torch.bool)
+    for b in np.ndindex(nb, nb, nb):
+        lo = [o * block // stride for o in b]
+        hi = [min(o * block + block, res - 1) // stride + 1 for o in b]
+        mask[b] = occ[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]].any()
+    return mask, pts.shape[0]
+
+
+def extract_mesh(density_fn, res, bound, thresh, block=64, coarse_stride=0):
+    """Runs marching cubes on the raw density of density_fn (pts [N, 3] ->
+    [N]) at level thresh, block by block. Returns welded verts [V, 3] in world
+    space, faces [F, 3] and the number of points evaluated.
+    """
+    nb = (res - 2) // block + 1
+    if coarse_stride > 0:
+        mask, n_points = coarse_block_mask(density_fn, res, bound, block, thresh, coarse_stride)
+        print('Coarse pass: {} of {} blocks occupied'.format(int(mask.sum()), nb**3))
+    else:
+        mask, n_points = torch.ones([nb, nb, nb], dtype=torch.bool), 0
+
+    verts, faces, n_verts = [], [], 0
+    for b in tqdm(np.ndindex(nb, nb, nb), total=nb**3):
+        if not mask[b]:
+            continue
+        lo = [o * block for o in b]
+        hi = [min(o + block + 1, res) for o in lo]
+        pts = lattice_points(lo, hi, res, bound)
+        volume = density_fn(pts.reshape(-1, 3)).reshape(pts.shape[:-1]).cpu().numpy()
+        n_points += volume.size
+        if volume.max() <= thresh or volume.min() >= thresh:
+            continue
+        v, f = marching_cubes(volume, thresh)
+        verts.append(v + np.array(lo))
+        faces.append(f + n_verts)
+        n_verts += v.shape[0]
+
+    if n_verts == 0:
+        return np.zeros([0, 3], np.float32), np.zeros([0, 3], np.int64), n_points
+    verts, faces = weld_vertices(np.concatenate(verts, 0), np.concatenate(faces, 0))
+    return (verts / (res - 1) * 2. * bound - bound).astype(np.float32), faces, n_points
+
+
+def weld_vertices(verts, faces, tol=1e-4):
+    """Merges vertices closer than tol (in lattice units) and drops the
+    triangles that become degenerate.
+    """
+    key = np.round(verts / tol).astype(np.int64)
+    _, first, inverse = np.unique(key, axis=0, return_index=True, return_inverse=True)
+    faces = inverse.reshape(-1)[faces]
+    keep = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    return verts[first], faces[keep]
+
+
+def density_normals(density_fn, verts, eps, chunk=1024*32):
+    """Outward unit normals -grad(sigma) at verts [V, 3], by central differences."""
+    offsets = torch.cat([torch.eye(3), -torch.eye(3)], 0) * eps
+    normals = []
+    for i in range(0, verts.shape[0], chunk):
+        pts = verts[i:i+chunk, None] + offsets
+        sigma = density_fn(pts.reshape(-1, 3)).reshape(-1, 6)
+        normals.append(-(sigma[:, :3] - sigma[:, 3:]))
+    return F.normalize(torch.cat(normals, 0), dim=-1)
+
+
+def vertex_colors(render_kwargs, verts, normals, chunk=1024*32):
+    """Sigmoid rgb of the network at verts, seen along -normals."""
+    fn = render_kwargs['network_fn'] if render_kwargs['network_fine'] is None else render_kwargs['network_fine']
+    colors = []
+    for i in range(0, verts.shape[0], chunk):
+        viewdirs = -normals[i:i+chunk] if render_kwargs['use_viewdirs'] else None
+        raw = render_kwargs['network_query_fn'](verts[i:i+chunk, None], viewdirs, fn)[:, 0]
+        colors.append(torch.sigmoid(raw[..., :3]))
+    return torch.cat(colors, 0)
+
+
+def orient_faces(verts, faces, normals):
+    """Flips triangles whose winding disagrees with the vertex normals."""
+    v0, v1, v2 = verts[faces[:, 0]], verts[faces[:, 1]], verts[faces[:, 2]]
+    flip = (np.cross(v1 - v0, v2 - v0) * normals[faces].sum(1)).sum(-1) < 0
+    faces[flip] = faces[flip][:, ::-1]
+    return faces
+
+
+def save_ply(path, verts, faces, colors):
+    """Binary little-endian PLY with uchar per-vertex colors."""
+    vertex = np.empty(verts.shape[0], dtype=[('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                                             ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+    vertex['x'], vertex['y'], vertex['z'] = verts.T
+    vertex['red'], vertex['green'], vertex['blue'] = colors.T
+    face = np.empty(faces.shape[0], dtype=[('n', 'u1'), ('v', '<i4', (3,))])
+    face['n'], face['v'] = 3, faces
+    with open(path, 'wb') as f:
+        f.write(('ply\nformat binary_little_endian 1.0\n'
+                 'element vertex {}\n'
+                 'property float x\nproperty float y\nproperty float z\n'
+                 'property uchar red\nproperty uchar green\nproperty uchar blue\n'
+                 'element face {}\nproperty list uchar int vertex_indices\n'
+                 'end_header\n').format(verts.shape[0], faces.shape[0]).encode('ascii'))
+        f.write(vertex.tobytes())
+        f.write(face.tobytes())
+
+
+def save_obj(path, verts, faces, colors):
+    """OBJ with the common 'v x y z r g b' vertex color extension."""
+    with open(path, 'w') as f:
+        np.savetxt(f, np.concatenate([verts, colors / 255.], -1), fmt='v %.6f %.6f %.6f %.4f %.4f %.4f')
+        np.savetxt(f, faces + 1, fmt='f %d %d %d')
+
+
+def export_mesh(render_kwargs, density_fn, path, res, bound, thresh, block=64, coarse_stride=0, chunk=1024*32):
+    """Extracts the thresh level set of density_fn on a res^3 lattice, colors
+    the vertices with the network and writes a .ply or .obj to path. Prints
+    the density throughput and the peak memory.
+    """
+    t = time.time()
+    with torch.no_grad():
+        verts, faces, n_points = extract_mesh(density_fn, res, bound, thresh, block, coarse_stride)
+    t_grid = time.time() - t
+    print('Evaluated {} points in {:.1f}s ({:.0f} points/sec)'.format(n_points, t_grid, n_points / max(t_grid, 1e-9)))
+    print('Mesh: {} vertices, {} faces'.format(verts.shape[0], faces.shape[0]))
+
+    if verts.shape[0] > 0:
+        with torch.no_grad():
+            pts = torch.Tensor(verts)
+            normals = density_normals(density_fn, pts, 2. * bound / (res - 1), chunk)
+            colors = vertex_colors(render_kwargs, pts, normals, chunk)
+        faces = orient_faces(verts, faces, normals.cpu().numpy())
+        colors = (np.clip(colors.cpu().numpy(), 0., 1.) * 255.).round().astype(np.uint8)
+    else:
+        colors = np.zeros([0, 3], np.uint8)
+
+    if path.endswith('.obj'):
+        save_obj(path, verts, faces, colors)
+    else:
+        save_ply(path, verts, faces, colors)
+
+    print('Peak RSS: {:.1f} MB'.format(peak_rss_mb()))
+    if torch.cuda.is_available():
+        print('Peak CUDA memory: {:.1f} MB'.format(torch.cuda.max_memory_allocated() / 2**20))
+    print('Total {:.1f}s'.format(time.time() - t))
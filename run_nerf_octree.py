@@ -0,0 +1,265 @@
+import os
+import json
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import trange
+
+from run_nerf_helpers import eval_sh_bases, SHNeRF
+
+
+# PlenOctree: density + SH coefficients stored at the leaves of a sparse
+# octree over [-bound, bound]^3, laid out like svox. Every node has 8 slots;
+# child[n, s] > 0 points to the node refining slot s, otherwise slot s is a
+# leaf whose values are data[n, s] = [raw sigma, 3 * sh_dim SH coefficients].
+class PlenOctree:
+    def __init__(self, child, data, bound, depth, sh_degree):
+        self.child = child  # [N_nodes, 8] int32
+        self.data = data  # [N_nodes, 8, 1 + 3*sh_dim] float16
+        self.bound = bound
+        self.depth = depth
+        self.sh_degree = sh_degree
+
+    def n_leaves(self):
+        return int((self.child == 0).sum().item())
+
+    def nbytes(self):
+        return self.child.numel() * self.child.element_size() + self.data.numel() * self.data.element_size()
+
+    def save(self, path):
+        """Writes meta.json, child.npy and data.npy into directory path."""
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'child.npy'), self.child.cpu().numpy())
+        np.save(os.path.join(path, 'data.npy'), self.data.cpu().numpy())
+        with open(os.path.join(path, 'meta.json'), 'w') as file:
+            json.dump({'bound' : self.bound, 'depth' : self.depth, 'sh_degree' : self.sh_degree}, file)
+
+    @classmethod
+    def load(cls, path, device='cpu', mmap=True):
+        """Loads a saved octree. With mmap on the CPU, child/data are backed by
+        copy-on-write memory maps and only the pages that rays touch are read.
+        """
+        with open(os.path.join(path, 'meta.json')) as file:
+            meta = json.load(file)
+        mmap_mode = 'c' if mmap else None
+        child = torch.from_numpy(np.load(os.path.join(path, 'child.npy'), mmap_mode=mmap_mode))
+        data = torch.from_numpy(np.load(os.path.join(path, 'data.npy'), mmap_mode=mmap_mode))
+        if torch.device(device).type != 'cpu':
+            child, data = child.to(device), data.to(device)
+        return cls(child, data, meta['bound'], meta['depth'], meta['sh_degree'])
+
+    def lookup(self, u):
+        """Finds the leaf containing each normalized point u [N, 3] in [0, 1)^3.
+        Returns node [N], slot [N] and the node's level [N] (root = 0).
+        """
+        N = u.shape[0]
+        node = torch.zeros([N], dtype=torch.long, device=u.device)
+        slot = torch.zeros([N], dtype=torch.long, device=u.device)
+        level = torch.zeros([N], dtype=torch.long, device=u.device)
+        done = torch.zeros([N], dtype=torch.bool, device=u.device)
+        for l in range(self.depth):
+            q = (u * 2**(l+1)).long().clamp(0, 2**(l+1) - 1) & 1
+            slot = torch.where(done, slot, q[:, 0] * 4 + q[:, 1] * 2 + q[:, 2])
+            ch = self.child[node, slot].long()
+            descend = ~done & (ch > 0)
+            node = torch.where(descend, ch, node)
+            level = torch.where(descend, level + 1, level)
+            done = done | ~descend
+        return node, slot, level
+
+    def render(self, rays_o, rays_d, viewdirs, near, far, white_bkgd=False, term_eps=1e-4, weights_out=None):
+        """Integrates every ray exactly through the leaves it crosses, one leaf
+        per step for all active rays at once. Empty space costs one step per
+        empty leaf, however large.
+        Args:
+          rays_o, rays_d, viewdirs: [N_rays, 3].
+          near, far: [N_rays].
+          term_eps: rays stop once their transmittance falls below this.
+          weights_out: optional [N_nodes * 8] tensor, receives the max
+            compositing weight of each leaf over all rays.
+        Returns:
+          rgb_map [N_rays, 3], disp_map [N_rays], acc_map [N_rays].
+        """
+        N_rays = rays_o.shape[0]
+        scale = 2. * self.bound
+        u0 = (rays_o + self.bound) / scale
+        dn = rays_d / scale
+        dn = torch.where(dn.abs() < 1e-9, 1e-9 * torch.ones_like(dn), dn)
+        inv = 1. / dn
+        ray_norm = torch.norm(rays_d, dim=-1)
+
+        # Clip [near, far] to the unit cube
+        ta, tb = -u0 * inv, (1. - u0) * inv
+        t = torch.max(torch.min(ta, tb).max(-1)[0], near)
+        t_end = torch.min(torch.max(ta, tb).min(-1)[0], far)
+        # Nudge past each exit face by a fraction of the finest cell
+        nudge = 1e-3 / 2**self.depth / dn.abs().max(-1)[0]
+
+        basis = eval_sh_bases(self.sh_degree, viewdirs)
+        T = torch.ones([N_rays], device=rays_o.device)
+        rgb_map = torch.zeros([N_rays, 3], device=rays_o.device)
+        depth_map = torch.zeros([N_rays], device=rays_o.device)
+        acc_map = torch.zeros([N_rays], device=rays_o.device)
+
+        idx = torch.nonzero(t < t_end, as_tuple=True)[0]
+        while idx.shape[0] > 0:
+            t_i = t[idx]
+            u = (u0[idx] + t_i[:, None] * dn[idx]).clamp(0., 1. - 1e-7)
+            node, slot, level = self.lookup(u)
+
+            cell = 0.5**(level + 1).to(u.dtype)[:, None]
+            lo = torch.floor(u / cell) * cell
+            t_exit = ((lo + cell * (dn[idx] > 0) - u0[idx]) * inv[idx]).min(-1)[0]
+            t_exit = torch.min(torch.max(t_exit, t_i), t_end[idx])
+
+            leaf = self.data[node, slot].to(device=u.device, dtype=u.dtype)
+            sigma = F.relu(leaf[:, 0])
+            alpha = 1. - torch.exp(-sigma * (t_exit - t_i) * ray_norm[idx])
+            sh = leaf[:, 1:].reshape(-1, 3, basis.shape[-1])
+            rgb = torch.sigmoid(torch.sum(sh * basis[idx][:, None], -1))
+
+            w = T[idx] * alpha
+            rgb_map[idx] += w[:, None] * rgb
+            depth_map[idx] += w * .5 * (t_i + t_exit)
+            acc_map[idx] += w
+            T[idx] = T[idx] * (1. - alpha)
+            if weights_out is not None:
+                scatter_max_(weights_out, node * 8 + slot, w)
+
+            t[idx] = t_exit + nudge[idx]
+            keep = (t[idx] < t_end[idx]) & (T[idx] > term_eps)
+            idx = idx[keep]
+
+        if white_bkgd:
+            rgb_map = rgb_map + (1. - acc_map[..., None])
+        disp_map = 1. / torch.max(1e-10 * torch.ones_like(depth_map), depth_map / torch.max(acc_map, 1e-10 * torch.ones_like(acc_map)))
+        return rgb_map, disp_map, acc_map
+
+
+def scatter_max_(out, index, src):
+    """out[index] = max(out[index], src) with repeated indices, without
+    scatter_reduce (not in torch 1.11): sort by value, then stably by index,
+    so the last entry of each index group is its maximum.
+    """
+    order = torch.argsort(src)
+    index_sorted, order_idx = torch.sort(index[order], stable=True)
+    src_sorted = src[order][order_idx]
+    uniq, counts = torch.unique_consecutive(index_sorted, return_counts=True)
+    last = torch.cumsum(counts, 0) - 1
+    out[uniq] = torch.max(out[uniq], src_sorted[last])
+
+
+def build_octree(coords, values, depth):
+    """Builds the node arrays for occupied voxels coords [M, 3] (integers in
+    [0, 2^depth)) holding values [M, C]. Returns child [N_nodes, 8] int32,
+    data [N_nodes, 8, C] and the leaf index (node * 8 + slot) of each voxel.
+    """
+    device = coords.device
+    coords = coords.long()
+    level_keys, level_base = [], []
+    n_nodes = 0
+    for l in range(depth):
+        k = coords >> (depth - l)
+        flat = torch.unique((k[:, 0] * 2**l + k[:, 1]) * 2**l + k[:, 2], sorted=True)
+        if l == 0:
+            # Keep the root even if nothing is occupied
+            flat = torch.zeros([1], dtype=torch.long, device=device)
+        level_keys.append(flat)
+        level_base.append(n_nodes)
+        n_nodes += flat.shape[0]
+
+    def node_index(k, l):
+        flat = (k[:, 0] * 2**l + k[:, 1]) * 2**l + k[:, 2]
+        return level_base[l] + torch.searchsorted(level_keys[l], flat)
+
+    child = torch.zeros([n_nodes, 8], dtype=torch.int32, device=device)
+    for l in range(1, depth):
+        flat = level_keys[l]
+        k = torch.stack([flat // 4**l, (flat // 2**l) % 2**l, flat % 2**l], -1)
+        q = k & 1
+        parent = node_index(k >> 1, l - 1)
+        child[parent, q[:, 0] * 4 + q[:, 1] * 2 + q[:, 2]] = (level_base[l] + torch.arange(flat.shape[0], device=device)).int()
+
+    q = coords & 1
+    leaf = node_index(coords >> 1, depth - 1) * 8 + q[:, 0] * 4 + q[:, 1] * 2 + q[:, 2]
+    data = torch.zeros([n_nodes * 8, values.shape[-1]], dtype=values.dtype, device=device)
+    data[leaf] = values
+    return child, data.reshape(n_nodes, 8, -1), leaf
+
+
+@torch.no_grad()
+def bake_octree_voxels(fn, network_query_fn, depth, bound, sigma_thresh, sh_degree=2, n_dirs=64):
+    """Evaluates fn at the voxel centers of a 2^depth grid one slab at a time
+    and keeps voxels with raw sigma > sigma_thresh. An SHNeRF gives its SH
+    coefficients directly; any other view-dependent model is converted by
+    projecting raw rgb over n_dirs random directions onto degree sh_degree SH.
+    Returns coords [M, 3], values [M, 1 + 3*sh_dim] and the SH degree.
+    """
+    R = 2**depth
+    t = (torch.arange(R, dtype=torch.float32) + .5) / R * 2. * bound - bound
+    y, z = torch.meshgrid(t, t, indexing='ij')
+
+    if isinstance(fn, SHNeRF):
+        sh_degree = fn.sh_degree
+        def query(x):
+            # One trunk pass feeds both the density and the SH head
+            h, alpha = fn.forward_density(x[..., :fn.input_ch])
+            return torch.cat([alpha, fn.forward_sh(h).flatten(-2)], -1)
+    else:
+        query = lambda x : fn.forward_density(x[..., :fn.input_ch])[1]
+    sh_dim = (sh_degree + 1)**2
+
+    coords, values = [], []
+    for i in trange(R):
+        pts = torch.stack([t[i].expand_as(y), y, z], -1)
+        out = network_query_fn(pts, None, query)
+        keep = torch.nonzero(out[..., 0] > sigma_thresh, as_tuple=False)
+        if keep.shape[0] == 0:
+            continue
+        vals = out[keep[:, 0], keep[:, 1]]
+        if not isinstance(fn, SHNeRF):
+            # Monte Carlo projection: c_lm = 4 pi / n sum_j raw(d_j) Y_lm(d_j)
+            p = pts[keep[:, 0], keep[:, 1]]
+            sh = torch.zeros([p.shape[0], 3, sh_dim])
+            for d in F.normalize(torch.randn([n_dirs, 3]), dim=-1):
+                raw = network_query_fn(p[:, None], d.expand(p.shape), fn)[:, 0]
+                sh += raw[:, :3, None] * eval_sh_bases(sh_degree, d)
+            vals = torch.cat([vals[:, :1], sh.flatten(-2) * 4. * np.pi / n_dirs], -1)
+        coords.append(torch.cat([torch.full_like(keep[:, :1], i), keep], -1))
+        values.append(vals)
+
+    if len(coords) == 0:
+        return torch.zeros([0, 3], dtype=torch.long), torch.zeros([0, 1 + 3*sh_dim]), sh_degree
+    return torch.cat(coords, 0), torch.cat(values, 0), sh_degree
+
+
+def bake_plenoctree(render_kwargs, rays, depth, bound, sigma_thresh, weight_thresh, sh_degree=2, n_dirs=64, chunk=1024*32):
+    """Bakes network_fine (or network_fn) into a PlenOctree and prunes leaves
+    whose max compositing weight over the training rays stays below
+    weight_thresh. rays is [2, N, 3] (rays_o, rays_d) or [3, N, 3] with the
+    view directions last; pass them when rays_d is in NDC, since like render()
+    they must come from the world-space rays_d.
+    """
+    fn = render_kwargs['network_fn'] if render_kwargs['network_fine'] is None else render_kwargs['network_fine']
+    coords, values, sh_degree = bake_octree_voxels(fn, render_kwargs['network_query_fn'], depth, bound, sigma_thresh, sh_degree, n_dirs)
+    print('Voxels above sigma threshold:', coords.shape[0])
+    child, data, leaf = build_octree(coords, values.half(), depth)
+    tree = PlenOctree(child, data, bound, depth, sh_degree)
+
+    weights = torch.zeros([child.shape[0] * 8], device=child.device)
+    with torch.no_grad():
+        for i in trange(0, rays.shape[1], chunk):
+            rays_o, rays_d = rays[0, i:i+chunk], rays[1, i:i+chunk]
+            if rays.shape[0] > 2:
+                viewdirs = rays[2, i:i+chunk]
+            else:
+                viewdirs = rays_d / torch.norm(rays_d, dim=-1, keepdim=True)
+            near = render_kwargs['near'] * torch.ones_like(rays_d[..., 0])
+            far = render_kwargs['far'] * torch.ones_like(rays_d[..., 0])
+            tree.render(rays_o, rays_d, viewdirs, near, far, weights_out=weights)
+
+    keep = weights[leaf] >= weight_thresh
+    print('Voxels kept after weight pruning:', int(keep.sum().item()))
+    child, data, _ = build_octree(coords[keep], values[keep].half(), depth)
+    return PlenOctree(child, data, bound, depth, sh_degree)
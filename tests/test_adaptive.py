@@ -0,0 +1,24 @@
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from run_nerf import adaptive_counts
+
+
+def test_adaptive_counts():
+    torch.manual_seed(0)
+    weights = torch.rand(64, 32) * (torch.rand(64, 1) < .7)
+    # One ray with almost all the content, that would take the whole budget
+    weights[0] = 100.
+
+    counts = adaptive_counts(weights, 500, 16)
+    assert counts.sum() == 500
+    assert counts.max() <= 16 and counts[0] == 16
+    assert torch.all(counts[weights.sum(-1) == 0] == 0)
+
+    # More than the cap allows: every non-empty ray capped
+    counts = adaptive_counts(weights, 10**4, 16)
+    assert torch.equal(counts, 16 * (weights.sum(-1) > 0).long())
@@ -0,0 +1,88 @@
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from run_nerf_helpers import NeRF, get_embedder, composite_rays, composite_weights
+from run_nerf import raw2outputs, run_network, march_rays
+
+
+def make_rays(N_rays=6, N_samples=10, dtype=torch.float64):
+    torch.manual_seed(0)
+    # Densities away from the relu kink at 0, of both signs
+    sigma = torch.rand(N_rays, N_samples, dtype=dtype) * 2. + .1
+    sigma = sigma * (1. - 2. * (torch.rand(N_rays, N_samples) < .2).to(dtype))
+    rgb_raw = torch.randn(N_rays, N_samples, 3, dtype=dtype)
+    z_vals = torch.sort(torch.rand(N_rays, N_samples, dtype=dtype) * 4. + 2., -1)[0]
+    rays_d = torch.randn(N_rays, 3, dtype=dtype)
+    return sigma, rgb_raw, z_vals, rays_d
+
+
+def test_composite_weights():
+    sigma, _, z_vals, _ = make_rays()
+    dists = torch.rand_like(z_vals)
+    trans0 = torch.rand(sigma.shape[0], dtype=sigma.dtype)
+    alpha, trans, weights = composite_weights(sigma, dists, trans0)
+
+    # w_i = alpha_i prod_{j<i} (1 - alpha_j + 1e-10), one sample at a time
+    t = trans0.clone()
+    for i in range(sigma.shape[-1]):
+        a = 1. - torch.exp(-torch.clamp(sigma[:, i], min=0.) * dists[:, i])
+        assert torch.allclose(alpha[:, i], a)
+        assert torch.allclose(trans[:, i], t)
+        assert torch.allclose(weights[:, i], a * t)
+        t = t * (1. - a + 1e-10)
+    assert torch.allclose(trans[:, -1], t)
+    assert torch.equal(composite_weights(sigma, dists)[1][:, 0], torch.ones_like(trans0))
+
+
+def test_gradcheck():
+    sigma, rgb_raw, z_vals, _ = make_rays()
+    dists = torch.rand_like(z_vals) * .5
+    sigma.requires_grad_(True)
+    rgb_raw.requires_grad_(True)
+    assert torch.autograd.gradcheck(lambda s, c : composite_rays(s, c, dists, z_vals), (sigma, rgb_raw))
+
+
+def test_matches_raw2outputs():
+    sigma, rgb_raw, z_vals, rays_d = make_rays(dtype=torch.float32)
+    raw = torch.cat([rgb_raw, sigma[..., None]], -1)
+    g = [torch.rand(6, 3), torch.rand(6), torch.rand(6), torch.rand(6, 10)]
+
+    outputs, grads = [], []
+    for fused in [False, True]:
+        x = raw.clone().requires_grad_(True)
+        rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(x, z_vals, rays_d, fused=fused)
+        loss = sum((out * w).sum() for out, w in zip([rgb_map, depth_map, acc_map, weights], g))
+        outputs.append([rgb_map, disp_map, acc_map, weights, depth_map])
+        grads.append(torch.autograd.grad(loss, x)[0])
+
+    for a, b in zip(*outputs):
+        assert torch.allclose(a, b, atol=1e-5)
+    assert torch.allclose(grads[0], grads[1], atol=1e-5)
+
+
+def test_march_rays_without_termination():
+    torch.manual_seed(0)
+    embed_fn, input_ch = get_embedder(4)
+    embeddirs_fn, input_ch_views = get_embedder(2)
+    model = NeRF(D=2, W=32, input_ch=input_ch, input_ch_views=input_ch_views, skips=[], use_viewdirs=True)
+    network_query_fn = lambda inputs, viewdirs, fn, **kwargs : run_network(inputs, viewdirs, fn, embed_fn, embeddirs_fn, **kwargs)
+
+    N_rays, N_samples = 16, 40
+    rays_o, rays_d = torch.randn(N_rays, 3), torch.randn(N_rays, 3)
+    viewdirs = torch.nn.functional.normalize(rays_d, dim=-1)
+    z_vals = torch.sort(torch.rand(N_rays, N_samples) * 2., -1)[0]
+
+    with torch.no_grad():
+        pts = rays_o[:, None] + rays_d[:, None] * z_vals[..., None]
+        raw = network_query_fn(pts, viewdirs, model)
+        expected = raw2outputs(raw, z_vals, rays_d, white_bkgd=True)
+        marched = march_rays(z_vals, rays_o, rays_d, viewdirs, model, network_query_fn,
+                             white_bkgd=True, segment=7, term_eps=0.)
+    for a, b in zip(marched[:5], expected):
+        assert torch.allclose(a, b, atol=1e-5)
+    assert torch.allclose(marched[5], raw, atol=1e-6)
+    assert torch.all(marched[6] == N_samples)
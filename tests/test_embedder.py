@@ -0,0 +1,49 @@
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from run_nerf_helpers import Embedder, get_embedder
+
+
+def make_embedder(multires=6, **kwargs):
+    return Embedder(include_input=True, input_dims=3, max_freq_log2=multires-1, num_freqs=multires,
+                    log_sampling=True, periodic_fns=[torch.sin, torch.cos], **kwargs)
+
+
+def test_matches_lambda_list():
+    eo = make_embedder()
+    x = torch.randn(100, 3)
+    expected = torch.cat([fn(x) for fn in eo.embed_fns], -1)
+    assert torch.equal(eo.embed(x), expected)
+
+    # Into a column slice of a wider buffer, as run_network() does
+    buf = torch.zeros(100, eo.out_dim + 5)
+    eo.embed(x, out=buf[:, :eo.out_dim])
+    assert torch.equal(buf[:, :eo.out_dim], expected)
+    assert torch.all(buf[:, eo.out_dim:] == 0)
+
+
+def test_get_embedder_out():
+    x = torch.randn(50, 3)
+    for i in [0, -1]:
+        embed, out_dim = get_embedder(4, i)
+        out = torch.empty(50, out_dim)
+        assert embed(x, out=out) is out
+        assert torch.equal(out, embed(x))
+
+
+def test_analytic_grad():
+    eo = make_embedder(analytic_grad=True)
+    eo.freq_bands = eo.freq_bands.double()
+    x = torch.randn(20, 3, dtype=torch.float64, requires_grad=True)
+    assert type(eo.embed(x).grad_fn).__name__ == '_PeriodicEncodeBackward'
+    assert torch.autograd.gradcheck(eo.embed, (x,))
+
+    # Same gradients as autograd through the plain forward
+    g = torch.randn(20, eo.out_dim, dtype=torch.float64)
+    analytic = torch.autograd.grad(eo.embed(x), x, g)[0]
+    eo.analytic_grad = False
+    assert torch.allclose(analytic, torch.autograd.grad(eo.embed(x), x, g)[0])
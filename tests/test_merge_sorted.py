@@ -0,0 +1,44 @@
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from run_nerf_helpers import merge_sorted
+
+
+def check(a, b):
+    merged, perm = merge_sorted(a, b)
+    cat = torch.cat([a, b], -1)
+    expected, expected_perm = torch.sort(cat, dim=-1, stable=True)
+    assert torch.equal(merged, expected)
+    # Stable sort of the concatenation: ties keep a before b
+    assert torch.equal(perm, expected_perm)
+    assert torch.equal(torch.gather(cat, -1, perm), merged)
+
+
+def test_random():
+    torch.manual_seed(0)
+    for M, K in [(64, 32), (32, 64), (1, 17), (17, 1), (8, 8)]:
+        a = torch.sort(torch.rand(50, M), -1)[0]
+        b = torch.sort(torch.rand(50, K), -1)[0]
+        check(a, b)
+
+
+def test_ties():
+    torch.manual_seed(0)
+    for M, K in [(16, 5), (5, 16), (12, 12)]:
+        # Few distinct values, ties within and across rows
+        a = torch.sort(torch.randint(0, 4, [30, M]).float(), -1)[0]
+        b = torch.sort(torch.randint(0, 4, [30, K]).float(), -1)[0]
+        check(a, b)
+    a = torch.ones(3, 4)
+    check(a, torch.ones(3, 6))
+
+
+def test_batch_dims():
+    torch.manual_seed(0)
+    a = torch.sort(torch.rand(4, 5, 9), -1)[0]
+    b = torch.sort(torch.rand(4, 5, 3), -1)[0]
+    check(a, b)
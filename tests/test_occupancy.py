@@ -0,0 +1,34 @@
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from run_nerf_helpers import OccupancyGrid, grid_cell_index, grid_cell_ijk
+
+
+def test_cell_helpers():
+    R, bound = 8, 1.5
+    cells = torch.arange(R**3)
+    ijk = grid_cell_ijk(cells, R)
+    centers = (ijk.float() + .5) / R * (2.*bound) - bound
+    assert torch.equal(grid_cell_index(centers, bound, R), cells)
+    outside = torch.tensor([[2., 0., 0.], [0., -1.6, 0.]])
+    assert torch.all(grid_cell_index(outside, bound, R) == -1)
+
+
+def test_first_update_covers_every_cell():
+    torch.manual_seed(0)
+    # Density only in a small ball, which a partial update would likely miss
+    density_fn = lambda pts : 10. * (pts.norm(dim=-1) < .3).float()
+    grid = OccupancyGrid(resolution=16, bound=1.5)
+    grid.update(density_fn, n_cells=4)
+    assert grid.query(torch.zeros(1, 3)).all()
+    assert 0. < grid.occupied_fraction() < .1
+
+    # Later partial updates keep the cells they do not query
+    density = grid.density.clone()
+    grid.update(lambda pts : torch.zeros(pts.shape[0]), n_cells=4)
+    assert (grid.density != density).sum() <= 8
+    assert grid.query(torch.zeros(1, 3)).all()
@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from run_nerf_data import LazyImages, pixel_cache_hash, dataset_files, pixel_cache_index_file, build_pixel_cache, \
+    DiskRaySampler, split_pixel_index
+
+
+N, H, W = 3, 8, 10
+K = np.array([[10., 0, 5.], [0, 10., 4.], [0, 0, 1]])
+
+
+def make_dataset(datadir, seed=0):
+    """A fake dataset: the images are also written to datadir, so that the
+    cache key sees them as files.
+    """
+    rng = np.random.RandomState(seed)
+    images = rng.randint(0, 256, [N, H, W, 3]).astype(np.float32) / 255.
+    poses = np.tile(np.eye(4, dtype=np.float32)[:3], [N, 1, 1])
+    poses[:, :, 3] = rng.randn(N, 3)
+    os.makedirs(os.path.join(datadir, 'train'), exist_ok=True)
+    for i in range(N):
+        np.save(os.path.join(datadir, 'train', 'r_{}.npy'.format(i)), images[i])
+    return images, poses
+
+
+def build(datadir, cache_dir, images, poses, settings={'half_res' : False}, block=16):
+    return build_pixel_cache(cache_dir, pixel_cache_hash(dataset_files(str(datadir)), settings), images, poses, K, block=block)
+
+
+def read_cache(cache_dir):
+    # Not through DiskRaySampler, its reader thread would keep the files mapped across rebuilds
+    with open(os.path.join(str(cache_dir), 'meta.json')) as f:
+        meta = json.load(f)
+    index = np.fromfile(os.path.join(str(cache_dir), pixel_cache_index_file(meta['index_dtype'])), dtype=meta['index_dtype'])
+    rgb = np.fromfile(os.path.join(str(cache_dir), 'rgb.u8'), dtype=np.uint8).reshape(-1, 3)
+    return index, rgb
+
+
+def test_build_reuse_rebuild(tmp_path):
+    datadir, cache_dir = tmp_path / 'data', tmp_path / 'cache'
+    images, poses = make_dataset(str(datadir))
+
+    assert build(datadir, cache_dir, images, poses)
+    index, rgb = read_cache(cache_dir)
+    assert index.dtype == np.int32
+    # Every pixel exactly once, with its own color
+    assert np.array_equal(np.sort(index), np.arange(N * H * W))
+    img_i, pix_y, pix_x = split_pixel_index(index, H, W)
+    assert np.array_equal(rgb, np.round(images[img_i, pix_y, pix_x] * 255.).astype(np.uint8))
+
+    # Same files, poses and settings: reused as is
+    mtime = os.path.getmtime(os.path.join(str(cache_dir), 'rgb.u8'))
+    assert not build(datadir, cache_dir, images, poses)
+    assert os.path.getmtime(os.path.join(str(cache_dir), 'rgb.u8')) == mtime
+
+    # A changed source image is picked up from its mtime and size alone
+    images_new, _ = make_dataset(str(datadir), seed=1)
+    st = os.stat(os.path.join(str(datadir), 'train', 'r_0.npy'))
+    os.utime(os.path.join(str(datadir), 'train', 'r_0.npy'), ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert build(datadir, cache_dir, images_new, poses)
+    index, rgb = read_cache(cache_dir)
+    img_i, pix_y, pix_x = split_pixel_index(index, H, W)
+    assert np.array_equal(rgb, np.round(images_new[img_i, pix_y, pix_x] * 255.).astype(np.uint8))
+    assert not build(datadir, cache_dir, images_new, poses)
+
+    # So are changed poses and loader settings
+    poses_new = poses.copy()
+    poses_new[0, 0, 3] += 1.
+    assert build(datadir, cache_dir, images_new, poses_new)
+    assert build(datadir, cache_dir, images_new, poses_new, settings={'half_res' : True})
+    assert not build(datadir, cache_dir, images_new, poses_new, settings={'half_res' : True})
+
+
+def test_lazy_images(tmp_path):
+    datadir, cache_dir = tmp_path / 'data', tmp_path / 'cache'
+    images, poses = make_dataset(str(datadir))
+    decoded = []
+    def load_fn(f):
+        decoded.append(f)
+        return np.load(f)
+    files = [os.path.join(str(datadir), 'train', 'r_{}.npy'.format(i)) for i in range(N)]
+    lazy = LazyImages(files, load_fn, [N, H, W, 3])
+
+    # Built one image at a time from the files
+    assert build_pixel_cache(str(cache_dir), pixel_cache_hash(lazy.files, {}), lazy, poses, K, block=16)
+    assert sorted(decoded) == sorted(files)
+    index, rgb = read_cache(cache_dir)
+    img_i, pix_y, pix_x = split_pixel_index(index, H, W)
+    assert np.array_equal(rgb, np.round(images[img_i, pix_y, pix_x] * 255.).astype(np.uint8))
+
+    # A valid cache decodes nothing
+    del decoded[:]
+    assert not build_pixel_cache(str(cache_dir), pixel_cache_hash(lazy.files, {}), lazy, poses, K, block=16)
+    assert decoded == []
+
+    sub = lazy.select([0, 2])
+    assert sub.shape == (2, H, W, 3) and decoded == []
+    assert np.array_equal(sub[1], images[2])
+    assert np.array_equal(lazy.map(lambda img : img[..., :1], 1)[np.array([1])], images[1:2, ..., :1])
+
+
+def test_blocks_mix_all_images(tmp_path):
+    datadir, cache_dir = tmp_path / 'data', tmp_path / 'cache'
+    images, poses = make_dataset(str(datadir))
+    build(datadir, cache_dir, images, poses, block=24)
+    index, _ = read_cache(cache_dir)
+    for b in range(0, N * H * W, 24):
+        counts = np.bincount(index[b:b+24] // (H * W), minlength=N)
+        assert counts.min() >= 24 // N - 1
+
+
+def test_sampler_epoch(tmp_path):
+    datadir, cache_dir = tmp_path / 'data', tmp_path / 'cache'
+    images, poses = make_dataset(str(datadir))
+    build(datadir, cache_dir, images, poses)
+    sampler = DiskRaySampler(str(cache_dir), torch.device('cpu'), block_size=32)
+
+    seen = []
+    for _ in range(N * H * W // 40):
+        batch_rays, target_s = sampler.sample(40)
+        assert batch_rays.shape == (2, 40, 3)
+        seen.append(target_s)
+    # One epoch serves every pixel once, in whatever order
+    seen = torch.cat(seen, 0).numpy()
+    expected = images.reshape(-1, 3)
+    to_set = lambda rgb : sorted(map(tuple, np.round(rgb * 255.).astype(np.uint8)))
+    assert to_set(seen) == to_set(expected)
+
+
+def test_sampler_reshuffles_blocks(tmp_path):
+    datadir, cache_dir = tmp_path / 'data', tmp_path / 'cache'
+    images, poses = make_dataset(str(datadir))
+    build(datadir, cache_dir, images, poses)
+    # A single block: only the shuffle within it can change the order between epochs
+    sampler = DiskRaySampler(str(cache_dir), torch.device('cpu'), block_size=N * H * W)
+    first, second = sampler.sample(N * H * W)[0], sampler.sample(N * H * W)[0]
+    assert not torch.equal(first, second)
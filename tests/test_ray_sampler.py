@@ -0,0 +1,33 @@
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from run_nerf_data import LazyImages, RaySampler, to_uint8
+from run_nerf_helpers import get_rays
+
+
+def test_images_per_view():
+    rng = np.random.RandomState(0)
+    N, H, W = 4, 6, 5
+    images = rng.rand(N, H, W, 4).astype(np.float32)
+    poses = np.tile(np.eye(4, dtype=np.float32)[:3], [N, 1, 1])
+    poses[:, :, 3] = rng.randn(N, 3)
+    K = np.array([[5., 0, 2.5], [0, 5., 3.], [0, 0, 1]])
+
+    i_train = [0, 2, 3]
+    for train_images in [[images[i] for i in i_train],
+                         LazyImages(range(N), lambda i : images[i], images.shape).select(i_train)]:
+        sampler = RaySampler(train_images, poses[i_train], K, torch.device('cpu'))
+        assert sampler.images.dtype == torch.uint8
+        assert np.array_equal(sampler.images.numpy(), to_uint8(images[i_train][..., :3]))
+
+    # Rays and colors of global pixel indices
+    idx = torch.arange(len(i_train) * H * W)
+    batch_rays, target_s = sampler.rays(idx)
+    rays_o, rays_d = get_rays(H, W, K, torch.Tensor(poses[2]))
+    assert torch.allclose(batch_rays[1, H*W:2*H*W], rays_d.reshape(-1, 3), atol=1e-6)
+    assert torch.allclose(target_s[H*W:2*H*W], torch.Tensor(to_uint8(images[2, ..., :3])).reshape(-1, 3) / 255.)
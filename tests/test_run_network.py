@@ -0,0 +1,34 @@
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from run_nerf_helpers import NeRF, FactorizedNeRF, get_embedder
+from run_nerf import run_network, run_network_factored
+
+
+def test_factored_matches_expanded():
+    torch.manual_seed(0)
+    embed_fn, input_ch = get_embedder(6)
+    embeddirs_fn, input_ch_views = get_embedder(3)
+    pts = torch.randn(20, 12, 3)
+    viewdirs = torch.nn.functional.normalize(torch.randn(20, 3), dim=-1)
+
+    for model in [NeRF(D=4, W=32, input_ch=input_ch, input_ch_views=input_ch_views, skips=[2], use_viewdirs=True),
+                  FactorizedNeRF(D=4, W=32, input_ch=input_ch, input_ch_views=input_ch_views, skips=[2], components=4, W_dir=32)]:
+        # Expanding viewdirs to every sample and feeding the full network is the reference
+        expected = run_network(pts, viewdirs, model, embed_fn, embeddirs_fn, netchunk=64)
+        for netchunk in [50, 1024]:
+            out = run_network_factored(pts, viewdirs, model, embed_fn, embeddirs_fn, netchunk=netchunk)
+            assert out.shape == expected.shape
+            assert torch.allclose(out, expected, atol=1e-5)
+
+        # Same gradients for the parameters
+        g = torch.randn_like(expected)
+        params = list(model.parameters())
+        grads = torch.autograd.grad((run_network(pts, viewdirs, model, embed_fn, embeddirs_fn) * g).sum(), params)
+        grads_f = torch.autograd.grad((run_network_factored(pts, viewdirs, model, embed_fn, embeddirs_fn) * g).sum(), params)
+        for a, b in zip(grads, grads_f):
+            assert torch.allclose(a, b, atol=1e-4)
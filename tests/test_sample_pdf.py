@@ -0,0 +1,85 @@
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from run_nerf_helpers import sample_pdf
+
+
+def reference_sample_pdf(bins, weights, N_samples, det=False, pytest=False):
+    # sample_pdf as it was before invert_cdf(), with the expanded gathers
+    weights = weights + 1e-5
+    pdf = weights / torch.sum(weights, -1, keepdim=True)
+    cdf = torch.cumsum(pdf, -1)
+    cdf = torch.cat([torch.zeros_like(cdf[...,:1]), cdf], -1)
+
+    if det:
+        u = torch.linspace(0., 1., steps=N_samples)
+        u = u.expand(list(cdf.shape[:-1]) + [N_samples])
+    else:
+        u = torch.rand(list(cdf.shape[:-1]) + [N_samples])
+
+    if pytest:
+        np.random.seed(0)
+        new_shape = list(cdf.shape[:-1]) + [N_samples]
+        if det:
+            u = np.linspace(0., 1., N_samples)
+            u = np.broadcast_to(u, new_shape)
+        else:
+            u = np.random.rand(*new_shape)
+        u = torch.Tensor(u)
+
+    u = u.contiguous()
+    inds = torch.searchsorted(cdf, u, right=True)
+    below = torch.max(torch.zeros_like(inds-1), inds-1)
+    above = torch.min((cdf.shape[-1]-1) * torch.ones_like(inds), inds)
+    inds_g = torch.stack([below, above], -1)
+
+    matched_shape = [inds_g.shape[0], inds_g.shape[1], cdf.shape[-1]]
+    cdf_g = torch.gather(cdf.unsqueeze(1).expand(matched_shape), 2, inds_g)
+    bins_g = torch.gather(bins.unsqueeze(1).expand(matched_shape), 2, inds_g)
+
+    denom = (cdf_g[...,1]-cdf_g[...,0])
+    denom = torch.where(denom<1e-5, torch.ones_like(denom), denom)
+    t = (u-cdf_g[...,0])/denom
+    return bins_g[...,0] + t * (bins_g[...,1]-bins_g[...,0])
+
+
+def make_bins(N_rays=32, N_bins=63):
+    torch.manual_seed(0)
+    bins = torch.sort(torch.rand(N_rays, N_bins + 1) * 4. + 2., -1)[0]
+    # Sparse weights, as on rays through empty space
+    weights = torch.rand(N_rays, N_bins) * (torch.rand(N_rays, N_bins) < .3)
+    return bins, weights
+
+
+def test_det_and_pytest_unchanged():
+    bins, weights = make_bins()
+    for det in [False, True]:
+        expected = reference_sample_pdf(bins, weights, 64, det=det, pytest=True)
+        assert torch.allclose(sample_pdf(bins, weights, 64, det=det, pytest=True), expected, atol=1e-6)
+    expected = reference_sample_pdf(bins, weights, 64, det=True)
+    assert torch.allclose(sample_pdf(bins, weights, 64, det=True), expected, atol=1e-6)
+
+
+def test_stratified_covers_every_stratum():
+    bins, weights = make_bins()
+    N = 16
+    samples = sample_pdf(bins, weights, N, stratified=True)
+    assert torch.all(samples[..., 1:] >= samples[..., :-1])
+
+    # Sample k lands where the cdf is in [k/N, (k+1)/N]
+    w = weights.numpy() + 1e-5
+    cdf = np.concatenate([np.zeros_like(w[:, :1]), np.cumsum(w / w.sum(-1, keepdims=True), -1)], -1)
+    u = np.stack([np.interp(s, b, c) for s, b, c in zip(samples.numpy(), bins.numpy(), cdf)])
+    k = np.arange(N)
+    assert np.all(u >= k / N - 1e-5) and np.all(u <= (k + 1) / N + 1e-5)
+
+    # So a bin with at least m/N of the mass gets at least m - 1 samples
+    for i in range(len(bins)):
+        counts = np.bincount(np.searchsorted(bins[i].numpy(), samples[i].numpy(), side='right') - 1, minlength=len(w[i]))
+        mass = w[i] / w[i].sum()
+        assert np.all(counts[:len(mass)] >= np.floor(mass * N) - 1)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+時間-PSNR 效能測試
+在相同的牆鐘時間預算下訓練多個設定檔 (預設為 MLP 的 lego.txt、體素網格的 lego_grid.txt 與 TensoRF 的 lego_tensorf.txt),
+定期在測試視角的固定像素子集上評估 PSNR, 並回報達到目標 PSNR 所需的訓練時間
+工具版本 - 放置在tools/benchmarks目錄
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+
+# 添加項目根目錄到路徑
+script_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.abspath(os.path.join(script_dir, '../..'))
+sys.path.append(project_root)
+
+from run_nerf import config_parser, create_nerf, get_grid_schedule, render, device
+from run_nerf_helpers import get_rays, get_rays_at, img2mse, mse2psnr
+from run_nerf_backends import replace_optimizer_params
+from load_blender import load_blender_data
+
+
+def load_scene(args):
+    """載入 blender 場景, 回傳訓練影像/位姿、評估用光線與內參"""
+    images, poses, _, hwf, i_split = load_blender_data(args.datadir, args.half_res, args.testskip)
+    i_train, _, i_test = i_split
+    if args.white_bkgd:
+        images = images[..., :3] * images[..., -1:] + (1. - images[..., -1:])
+    else:
+        images = images[..., :3]
+
+    H, W, focal = hwf
+    H, W = int(H), int(W)
+    K = np.array([[focal, 0, 0.5*W], [0, focal, 0.5*H], [0, 0, 1]])
+    return images, poses[:, :3, :4], i_train, i_test, H, W, K
+
+
+def make_eval_rays(images, poses, i_test, H, W, K, n_views, n_pixels):
+    """從前 n_views 張測試影像中固定抽取 n_pixels 個像素作為評估集"""
+    rng = np.random.RandomState(0)
+    rays, target = [], []
+    for i in i_test[:n_views]:
+        rays_o, rays_d = get_rays(H, W, K, torch.Tensor(poses[i]))
+        idx = torch.from_numpy(rng.choice(H * W, min(n_pixels // n_views, H * W), replace=False))
+        rays.append(torch.stack([rays_o.reshape(-1, 3)[idx], rays_d.reshape(-1, 3)[idx]], 0))
+        target.append(torch.Tensor(images[i]).reshape(-1, 3)[idx])
+    return torch.cat(rays, 1), torch.cat(target, 0)
+
+
+def evaluate(rays, target, H, W, K, chunk, render_kwargs_test):
+    with torch.no_grad():
+        rgb, _, _, _ = render(H, W, K, chunk=chunk, rays=rays, **render_kwargs_test)
+    return mse2psnr(img2mse(rgb, target)).item()
+
+
+def run(config, scene, eval_set, bench_args, basedir):
+    overrides = ['--N_rand', str(bench_args.N_rand)] if bench_args.N_rand else []
+    args = config_parser().parse_args(['--config', config, '--basedir', basedir, '--no_reload'] + overrides)
+    os.makedirs(os.path.join(basedir, args.expname), exist_ok=True)
+    images, poses, i_train, _, H, W, K = scene
+    eval_rays, eval_target = eval_set
+
+    render_kwargs_train, render_kwargs_test, _, _, optimizer = create_nerf(args)
+    render_kwargs_train.update({'near' : 2., 'far' : 6.})
+    render_kwargs_test.update({'near' : 2., 'far' : 6.})
+
+    grid_schedule = get_grid_schedule(args)
+
+    history = []
+    train_time = 0.
+    i = 0
+    while train_time < bench_args.time_budget:
+        t = time.time()
+        img_i = np.random.choice(i_train)
+        target = torch.Tensor(images[img_i]).to(device)
+        select = torch.randint(H * W, [args.N_rand])
+        c2w = torch.Tensor(poses[img_i]).to(device).expand(args.N_rand, 3, 4)
+        batch_rays = torch.stack(get_rays_at(K, c2w, (select // W).float(), (select % W).float()), 0)
+        target_s = target.reshape(-1, 3)[select]
+
+        rgb, _, _, extras = render(H, W, K, chunk=args.chunk, rays=batch_rays, retraw=True, **render_kwargs_train)
+        loss = img2mse(rgb, target_s)
+        if 'rgb0' in extras:
+            loss = loss + img2mse(extras['rgb0'], target_s)
+        if 'prop_loss' in extras:
+            loss = loss + args.prop_loss_mult * torch.mean(extras['prop_loss'])
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        new_lrate = args.lrate * (0.1 ** (i / (args.lrate_decay * 1000)))
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = new_lrate * param_group.get('lr_mult', 1.)
+        if i in grid_schedule:
+            model = render_kwargs_train['network_fn']
+            if hasattr(model, 'prune'):
+                model.prune(args.grid_prune_thresh)
+            old_params = list(model.parameters())
+            model.upsample(**grid_schedule[i])
+            replace_optimizer_params(optimizer, old_params, list(model.parameters()))
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        train_time += time.time() - t
+        i += 1
+
+        if i % bench_args.eval_every == 0:
+            psnr = evaluate(eval_rays, eval_target, H, W, K, args.chunk, render_kwargs_test)
+            history.append((i, train_time, psnr))
+            print(f"  [{args.expname}] iter {i:6d}  {train_time:8.1f}s  PSNR {psnr:.2f}")
+    return args.expname, history
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', type=str, nargs='+',
+                        default=[os.path.join(project_root, 'configs/lego.txt'),
+                                 os.path.join(project_root, 'configs/lego_grid.txt'),
+                                 os.path.join(project_root, 'configs/lego_tensorf.txt')])
+    parser.add_argument('--datadir', type=str, default=os.path.join(project_root, 'data/nerf_synthetic/lego'))
+    parser.add_argument('--time_budget', type=float, default=600., help='每個設定檔的訓練時間 (秒)')
+    parser.add_argument('--eval_every', type=int, default=100)
+    parser.add_argument('--target_psnr', type=float, default=23.)
+    parser.add_argument('--n_eval_views', type=int, default=4)
+    parser.add_argument('--n_eval_pixels', type=int, default=4096)
+    parser.add_argument('--testskip', type=int, default=8)
+    parser.add_argument('--N_rand', type=int, default=None, help='覆寫設定檔的 batch 大小 (CPU 記憶體不足時使用)')
+    args = parser.parse_args()
+
+    args.half_res, args.white_bkgd = True, True
+    scene = load_scene(args)
+    images, poses, _, i_test, H, W, K = scene
+    eval_set = make_eval_rays(images, poses, i_test, H, W, K, args.n_eval_views, args.n_eval_pixels)
+
+    results = []
+    with tempfile.TemporaryDirectory() as basedir:
+        for config in args.configs:
+            torch.manual_seed(0)
+            np.random.seed(0)
+            print(f"🚀 訓練 {config} ({device}, {args.time_budget:.0f}s)")
+            results.append(run(os.path.abspath(config), scene, eval_set, args, basedir))
+
+    print(f"\n📊 達到 PSNR {args.target_psnr:.1f} 所需時間")
+    for expname, history in results:
+        hit = [h for h in history if h[2] >= args.target_psnr]
+        best = max(h[2] for h in history) if history else float('nan')
+        if hit:
+            print(f"  {expname:12s} {hit[0][1]:8.1f}s (iter {hit[0][0]}), 最佳 PSNR {best:.2f}")
+        else:
+            print(f"  {expname:12s} 未達到, 最佳 PSNR {best:.2f}")
+
+
+if __name__ == '__main__':
+    main()